@@ -0,0 +1,355 @@
+# bench.py
+# Replay synthetic update streams through the same Application main() builds,
+# against a fake Bot API and a stubbed Postgres pool, and report latency,
+# throughput and round trips per update.
+#
+#   python bench.py                          # all scenarios
+#   python bench.py --scenario dice_flood --updates 20000 --api-latency 0.03
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import logging
+import contextlib
+from urllib.parse import parse_qs
+import httpx
+from telegram import Update
+
+os.environ.setdefault("DICE_REVEAL_DELAY", "0")
+import main
+
+BOT_ID = 1000
+
+# =========================
+# Fake Telegram Bot API
+# =========================
+class FakeBotAPI(httpx.AsyncBaseTransport):
+    """httpx transport answering Bot API calls locally, with optional latency and injected 429s.
+
+    Only the transport is fake: calls still go through main.TelegramRequest, so
+    coalescing, rate limiting and 429 handling are part of what gets measured.
+    """
+
+    def __init__(self, latency: float = 0.0, retry_after_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.retry_after_rate = retry_after_rate
+        self.rng = random.Random(seed)
+        self.calls: dict[str, int] = {}
+        self.sent: list[tuple[int, str]] = []
+        self._message_ids = 0
+
+    def reset(self):
+        self.calls.clear()
+        self.sent.clear()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        endpoint = request.url.path.rsplit("/", 1)[-1]
+        body = (await request.aread()).decode()
+        params = {k: _param(v[-1]) for k, v in parse_qs(body).items()}
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if endpoint == "sendMessage" and self.rng.random() < self.retry_after_rate:
+            return httpx.Response(429, content=json.dumps({
+                "ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1},
+            }).encode())
+        return httpx.Response(200, content=json.dumps({"ok": True, "result": self._result(endpoint, params)}).encode())
+
+    def _result(self, endpoint: str, params: dict):
+        if endpoint == "getMe":
+            return {"id": BOT_ID, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        if endpoint == "sendMessage":
+            self._message_ids += 1
+            self.sent.append((params.get("chat_id"), params.get("text")))
+            return {"message_id": self._message_ids, "date": int(time.time()),
+                    "chat": {"id": params.get("chat_id"), "type": "supergroup"}, "text": params.get("text")}
+        if endpoint == "getChat":
+            return {"id": params.get("chat_id"), "type": "supergroup", "title": f"Group {params.get('chat_id')}"}
+        if endpoint == "getChatAdministrators":
+            return [{"status": "creator", "is_anonymous": False,
+                     "user": {"id": 1, "is_bot": False, "first_name": "Admin"}},
+                    {"status": "administrator", "can_be_edited": False, "is_anonymous": False,
+                     "can_manage_chat": True, "can_delete_messages": True, "can_manage_video_chats": True,
+                     "can_restrict_members": True, "can_promote_members": False, "can_change_info": True,
+                     "can_invite_users": True, "can_post_stories": False, "can_edit_stories": False,
+                     "can_delete_stories": False,
+                     "user": {"id": BOT_ID, "is_bot": True, "first_name": "Bench"}}]
+        if endpoint == "getChatMember":
+            return {"status": "member", "user": {"id": params.get("user_id"), "is_bot": False, "first_name": "U"}}
+        return True
+
+def _param(value: str):
+    return int(value) if value.lstrip("-").isdigit() else value
+
+def make_request(api: FakeBotAPI, global_rate: float | None = None) -> "main.TelegramRequest":
+    """The production request class on top of the fake transport."""
+    limiter = None
+    if global_rate:
+        limiter = main.RateLimiter(global_rate, main.TG_GROUP_RATE, main.TG_GROUP_BURST,
+                                   main.TG_PRIVATE_RATE, main.TG_PRIVATE_BURST)
+    return main.TelegramRequest(limiter=limiter, httpx_kwargs={"transport": api})
+
+# =========================
+# Stub Postgres
+# =========================
+_ROW = {"username": "boss", "user_id": 42, "name": "Boss", "paid": False,
+        "players": 3, "rolls": 120, "jackpots": 2, "triples": 5, "id": 1,
+        "chat_id": -100, "fail_count": 0, "fail_kind": None, "known": 0}
+
+def _chat_key(args) -> int:
+    return abs(args[0]) if args and isinstance(args[0], int) else 42
+
+class FakeConnection:
+    def __init__(self, pool: "FakePool"):
+        self.pool = pool
+        # prepared statements answer like the connection itself
+        self.stmts = {name: FakeStatement(self) for name in main.HOT_SQL}
+
+    async def _trip(self):
+        self.pool.round_trips += 1
+        if self.pool.latency:
+            await asyncio.sleep(self.pool.latency)
+
+    async def execute(self, query, *args, **kwargs):
+        await self._trip()
+        return "INSERT 0 1"
+
+    async def executemany(self, query, args, **kwargs):
+        await self._trip()
+
+    async def fetch(self, query, *args, **kwargs):
+        await self._trip()
+        # user ids derived from the chat, so every group has its own contact / notifiers
+        base = _chat_key(args) * 10
+        return [dict(_ROW, user_id=base + i, username=f"@user{base + i}") for i in range(3)]
+
+    async def fetchrow(self, query, *args, **kwargs):
+        await self._trip()
+        return dict(_ROW, user_id=_chat_key(args) * 10 + 9)
+
+    async def fetchval(self, query, *args, **kwargs):
+        await self._trip()
+        return 1
+
+    def transaction(self):
+        return _NullAsyncContext()
+
+class FakeStatement:
+    def __init__(self, conn: FakeConnection):
+        self.conn = conn
+
+    async def fetch(self, *args, **kwargs):
+        return await self.conn.fetch(None, *args)
+
+    async def fetchrow(self, *args, **kwargs):
+        return await self.conn.fetchrow(None, *args)
+
+    async def fetchval(self, *args, **kwargs):
+        return await self.conn.fetchval(None, *args)
+
+class _NullAsyncContext:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+class FakePool:
+    """Just enough of asyncpg.Pool for the helpers in main.py; counts round trips."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.round_trips = 0
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, timeout=None):
+        yield FakeConnection(self)
+
+    def get_size(self):
+        return 1
+
+    def get_idle_size(self):
+        return 1
+
+# =========================
+# Synthetic updates
+# =========================
+class UpdateFactory:
+    def __init__(self, seed: int = 0):
+        self.rng = random.Random(seed)
+        self.update_id = 0
+
+    def _message(self, chat_id: int, user_id: int, **extra) -> dict:
+        self.update_id += 1
+        return {"update_id": self.update_id, "message": {
+            "message_id": self.update_id, "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": f"Group {chat_id}"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"U{user_id}", "username": f"user{user_id}"},
+            **extra,
+        }}
+
+    def dice(self, chat_id: int, user_id: int, value: int | None = None) -> dict:
+        value = value or self.rng.randint(1, 64)
+        return self._message(chat_id, user_id, dice={"emoji": "🎰", "value": value})
+
+    def command(self, chat_id: int, user_id: int, text: str) -> dict:
+        cmd = text.split()[0]
+        return self._message(chat_id, user_id, text=text,
+                             entities=[{"type": "bot_command", "offset": 0, "length": len(cmd)}])
+
+    def text(self, chat_id: int, user_id: int, text: str = "hello") -> dict:
+        return self._message(chat_id, user_id, text=text)
+
+def dice_flood(f: UpdateFactory, n: int):
+    """A handful of busy groups, many users rolling 🎰."""
+    for _ in range(n):
+        yield f.dice(-100 - f.rng.randint(1, 5), f.rng.randint(1, 500))
+
+def command_mix(f: UpdateFactory, n: int):
+    """Commands, chatter and rolls spread over many groups."""
+    commands = ["/start", "/help", "/getcontact", "/getpaid", "/stats", "/leaderboard", "/setcontact @boss"]
+    for _ in range(n):
+        chat_id, user_id = -100 - f.rng.randint(1, 200), f.rng.randint(1, 2000)
+        r = f.rng.random()
+        if r < 0.4:
+            yield f.command(chat_id, user_id, f.rng.choice(commands))
+        elif r < 0.7:
+            yield f.text(chat_id, user_id)
+        else:
+            yield f.dice(chat_id, user_id)
+
+def jackpot_burst(f: UpdateFactory, n: int):
+    """Every roll a 777, across many groups and users."""
+    for _ in range(n):
+        yield f.dice(-100 - f.rng.randint(1, 1000), f.rng.randint(1, 5000), value=main.JACKPOT_VALUE)
+
+def command_spam(f: UpdateFactory, n: int):
+    """One user spamming /help in one group while other groups keep rolling."""
+    for i in range(n):
+        if i % 2:
+            yield f.command(-100, 7, "/help")
+        else:
+            yield f.dice(-200 - f.rng.randint(1, 50), f.rng.randint(1, 500))
+
+SCENARIOS = {"dice_flood": dice_flood, "command_mix": command_mix, "jackpot_burst": jackpot_burst,
+             "command_spam": command_spam}
+
+# =========================
+# Runner
+# =========================
+def reset_state():
+    for cache in (main._title_cache, main._contact_cache, main._admin_cache,
+                  main._user_buckets, main._chat_buckets, main._seen_updates):
+        cache.clear()
+    main.throttle_hits.clear()
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def _refused() -> int:
+    return int(sum(main.tg_refused._values.values()))
+
+async def run_scenario(app, api: FakeBotAPI, pool: FakePool, name: str, n: int, seed: int) -> dict:
+    reset_state()
+    api.reset()
+    refused = _refused()
+    pool.round_trips = 0
+    updates = [Update.de_json(data, app.bot) for data in SCENARIOS[name](UpdateFactory(seed), n)]
+
+    latencies = []
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        t0 = time.perf_counter()
+        for update in updates:
+            t = time.perf_counter()
+            await app.process_update(update)
+            latencies.append(time.perf_counter() - t)
+        elapsed = time.perf_counter() - t0
+        # background work the updates caused: batched writes, jackpot reveals
+        await main._title_writes.stop()
+        await main._roll_writes.stop()
+        await main.stop_jackpot_workers(timeout=60)
+        await main._health_writes.stop()
+        await main.drain_background_tasks(timeout=60)
+        await main._health_writes.flush()
+        drained = time.perf_counter() - t0
+    main._title_writes.start()
+    main._roll_writes.start()
+    main._health_writes.start()
+    main.start_jackpot_workers(app.bot, recover=False)
+
+    api_calls = sum(api.calls.values())
+    return {
+        "scenario": name, "updates": n,
+        "throughput": n / elapsed if elapsed else float("inf"),
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "max_ms": max(latencies) * 1000 if latencies else 0.0,
+        "drain_s": drained - elapsed,
+        "db_per_update": pool.round_trips / n,
+        "api_per_update": api_calls / n,
+        "api_calls": dict(sorted(api.calls.items())),
+        "throttled": sum(main.throttle_hits.values()),
+        "refused": _refused() - refused,
+    }
+
+def print_report(results: list[dict], out=sys.stdout):
+    header = f"{'scenario':<14}{'updates':>9}{'upd/s':>11}{'p50 ms':>9}{'p99 ms':>9}{'max ms':>9}{'db/upd':>8}{'api/upd':>9}{'throttled':>10}{'refused':>9}"
+    print(header, file=out)
+    print("-" * len(header), file=out)
+    for r in results:
+        print(f"{r['scenario']:<14}{r['updates']:>9}{r['throughput']:>11.0f}{r['p50_ms']:>9.3f}{r['p99_ms']:>9.3f}"
+              f"{r['max_ms']:>9.2f}{r['db_per_update']:>8.3f}{r['api_per_update']:>9.3f}{r['throttled']:>10}{r['refused']:>9}", file=out)
+    for r in results:
+        print(f"\n{r['scenario']}: background drain {r['drain_s']:.2f}s, api calls {r['api_calls']}", file=out)
+
+async def run(args) -> list[dict]:
+    if args.no_throttle:
+        main.DICE_USER_RATE = main.DICE_CHAT_RATE = 0
+    api = FakeBotAPI(args.api_latency, args.retry_after_rate, args.seed)
+    pool = FakePool(args.db_latency)
+    main._pool = pool
+    app = main.build_application(f"{BOT_ID}:bench", request=make_request(api, args.global_rate))
+    await app.initialize()
+    main._title_writes.start()
+    main._roll_writes.start()
+    main._health_writes.start()
+    main.start_jackpot_workers(app.bot, recover=False)
+    try:
+        names = list(SCENARIOS) if args.scenario == "all" else [args.scenario]
+        return [await run_scenario(app, api, pool, name, args.updates, args.seed) for name in names]
+    finally:
+        await main._title_writes.stop()
+        await main._roll_writes.stop()
+        await main.stop_jackpot_workers()
+        await main._health_writes.stop()
+        await app.shutdown()
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Replay synthetic updates through the bot's update pipeline.")
+    p.add_argument("--scenario", choices=["all", *SCENARIOS], default="all")
+    p.add_argument("--updates", type=int, default=5000, help="updates per scenario")
+    p.add_argument("--api-latency", type=float, default=0.0, help="seconds per fake Bot API call")
+    p.add_argument("--db-latency", type=float, default=0.0, help="seconds per fake DB round trip")
+    p.add_argument("--retry-after-rate", type=float, default=0.0, help="share of sendMessage calls answered with 429")
+    p.add_argument("--global-rate", type=float, default=1000,
+                   help="bot-wide send rate for the limiter (production: TG_GLOBAL_RATE); per-chat limits are as in production")
+    p.add_argument("--no-throttle", action="store_true", help="disable the dice throttle")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--json", action="store_true", help="print results as JSON")
+    return p.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.getLogger().setLevel(logging.CRITICAL)
+    results = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_report(results)
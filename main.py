@@ -1,81 +1,919 @@
 # main.py
 import os
+import re
+import html
+import atexit
+import json
+import time
+import queue
+import signal
+import random
 import asyncio
+import hashlib
+import functools
+import contextvars
+import contextlib
+import multiprocessing
+import httpx
+from collections import OrderedDict, Counter
+from datetime import date, datetime, timedelta, timezone
+from typing import NamedTuple
 from urllib.parse import urlparse
 import asyncpg
 from dotenv import load_dotenv
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.constants import ParseMode
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyParameters
+from telegram.constants import ParseMode, DiceEmoji
 from telegram.error import Forbidden
-from textwrap import dedent
-from telegram import BotCommand
-from telegram.error import Forbidden, BadRequest, RetryAfter
+from telegram import BotCommand, Bot
+from telegram.error import Forbidden, BadRequest, RetryAfter, NetworkError
 import logging
+import logging.handlers
 from telegram.error import BadRequest
+from telegram.request import HTTPXRequest
 from telegram.ext import (
-    Application, CommandHandler, MessageHandler, ContextTypes, filters
+    Application, ApplicationHandlerStop, CommandHandler, MessageHandler, ChatMemberHandler,
+    TypeHandler, ContextTypes, filters
 )
 load_dotenv()
 log = logging.getLogger("bot")
-logging.basicConfig(level=logging.INFO)
+
+# =========================
+# Logging
+# =========================
+# Handlers only put records on a queue; a QueueListener thread formats and
+# writes them, so a slow stdout never blocks the event loop. Output is one JSON
+# object per line (LOG_FORMAT=text for plain lines). Per-update events go
+# through log_event(), which applies a level and a sample rate per event type:
+#   LOG_EVENTS="dice=INFO:0.01,text=INFO:0,handler=DEBUG:1"
+LOG_LEVEL        = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT       = os.getenv("LOG_FORMAT", "json")
+LOG_MESSAGE_TEXT = os.getenv("LOG_MESSAGE_TEXT", "0") == "1"  # include chat text in "text" events
+
+# event -> (level, sample rate)
+EVENT_DEFAULTS = {
+    "dice":    (logging.INFO, 0.01),
+    "jackpot": (logging.INFO, 1.0),
+    "text":    (logging.INFO, 0.0),   # off: volume would follow chat traffic
+    "handler": (logging.DEBUG, 1.0),  # per-update latency
+}
+
+def _parse_level(level: str) -> int:
+    """"INFO" / "debug" / "10" -> logging level number; ValueError for anything else."""
+    if level.isdecimal():
+        return int(level)
+    try:
+        return logging.getLevelNamesMapping()[level.upper()]
+    except KeyError:
+        raise ValueError(f"unknown log level {level!r}") from None
+
+def _parse_log_events(raw: str) -> dict[str, tuple[int, float]]:
+    events = dict(EVENT_DEFAULTS)
+    for item in filter(None, (p.strip() for p in raw.split(","))):
+        name, _, spec = item.partition("=")
+        level, _, rate = spec.partition(":")
+        default_level, default_rate = events.get(name, (logging.INFO, 1.0))
+        try:
+            events[name] = (_parse_level(level) if level else default_level,
+                            float(rate) if rate else default_rate)
+        except ValueError as ex:
+            raise RuntimeError(f"Bad LOG_EVENTS entry {item!r}: {ex}") from None
+    return events
+
+LOG_EVENTS = _parse_log_events(os.getenv("LOG_EVENTS", ""))
+event_log  = logging.getLogger("bot.events")
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            **getattr(record, "fields", {}),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class _LoopQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # merge args now (they may change later) but leave formatting to the listener thread
+        record.msg, record.args = record.getMessage(), None
+        return record
+
+def setup_logging() -> logging.handlers.QueueListener:
+    out = logging.StreamHandler()
+    out.setFormatter(JsonFormatter() if LOG_FORMAT == "json"
+                     else logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    q = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers[:] = [_LoopQueueHandler(q)]
+    root.setLevel(LOG_LEVEL)
+    # httpx logs every Bot API call at INFO
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    listener = logging.handlers.QueueListener(q, out, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+_log_listener = setup_logging()
+
+def event_enabled(event: str) -> bool:
+    """Cheap pre-check so hot paths can skip building fields for muted events."""
+    level, rate = LOG_EVENTS.get(event, (logging.INFO, 1.0))
+    return rate > 0 and event_log.isEnabledFor(level)
+
+def log_event(event: str, **fields):
+    """Structured per-update log line, subject to the event's level and sample rate."""
+    level, rate = LOG_EVENTS.get(event, (logging.INFO, 1.0))
+    if rate <= 0 or not event_log.isEnabledFor(level):
+        return
+    if rate < 1 and random.random() >= rate:
+        return
+    event_log.log(level, event, extra={"fields": {"event": event, **fields}})
+
 # =========================
 # Config / DB helpers
 # =========================
 DB_URL = os.getenv("DATABASE_URL")
 OWNER_USERNAME = os.getenv("OWNER_USERNAME", "Moooniz_YouTube")  # your @ without '@'
 OWNER_USER_ID  = int(os.getenv("OWNER_USER_ID", "0")) or None
+# identifies this process to Postgres (application_name), so we can ignore our own NOTIFYs
+BOT_INSTANCE   = f"roulette-bot-{os.getpid()}-{random.getrandbits(32):08x}"
 _pool: asyncpg.Pool | None = None
 
+# =========================
+# In-process caches
+# =========================
+class TTLCache:
+    """Small LRU cache with a per-entry expiry (monotonic clock)."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        value, expires = item
+        if expires < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def __contains__(self, key) -> bool:
+        sentinel = object()
+        return self.get(key, sentinel) is not sentinel
+
+    def set(self, key, value, ttl: float | None = None):
+        self._data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return default if item is None else item[0]
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+class WriteBehind:
+    """Collect writes keyed by e.g. chat_id, merge repeats, and flush them in bulk.
+
+    A flush happens every `interval` seconds or as soon as `max_pending` keys are
+    waiting. `flush_fn` gets the whole {key: value} batch; if it raises, the batch
+    is merged back and retried on the next round.
+    """
+
+    def __init__(self, name: str, flush_fn, merge=None, max_pending: int = 500, interval: float = 2.0):
+        self.name = name
+        self.max_pending = max_pending
+        self.interval = interval
+        self._flush_fn = flush_fn
+        self._merge = merge or (lambda old, new: new)
+        self._pending: dict = {}
+        self._wake = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+        self._stopping = False
+
+    def put(self, key, value):
+        if key in self._pending:
+            value = self._merge(self._pending[key], value)
+        self._pending[key] = value
+        if len(self._pending) >= self.max_pending:
+            self._wake.set()
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def items(self):
+        """Writes still waiting for a flush."""
+        return self._pending.items()
+
+    async def flush(self):
+        async with self._lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            try:
+                await self._flush_fn(batch)
+            except Exception:
+                log.exception("%s: flush of %d items failed, will retry", self.name, len(batch))
+                for key, value in batch.items():
+                    self._pending[key] = self._merge(value, self._pending[key]) if key in self._pending else value
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._stopping = False
+            self._task = spawn(self._run(), name=f"write-behind:{self.name}")
+
+    async def stop(self):
+        """Stop the timer and write out whatever is still pending."""
+        # ask the loop to finish instead of cancelling it: wait_for() can swallow a
+        # cancel that races with the wake-up, and a flush shouldn't be cut in half
+        self._stopping = True
+        self._wake.set()
+        if self._task:
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+# chat_id -> last title we saw / wrote to Postgres
+TITLE_CACHE_TTL  = float(os.getenv("TITLE_CACHE_TTL", "3600"))
+TITLE_CACHE_SIZE = int(os.getenv("TITLE_CACHE_SIZE", "10000"))
+_title_cache = TTLCache(TITLE_CACHE_SIZE, TITLE_CACHE_TTL)
+
+class ContactRecord(NamedTuple):
+    """What the hot path needs from a contacts row."""
+    exists: bool
+    username: str | None
+    user_id: int | None
+    name: str | None
+    paid: bool
+
+_NO_CONTACT = ContactRecord(False, None, None, None, False)
+
+# chat_id -> ContactRecord. Written through by the contact/paid helpers and
+# invalidated across replicas by the contacts_changed NOTIFY (see contacts_listener).
+CONTACT_CACHE_TTL  = float(os.getenv("CONTACT_CACHE_TTL", "900"))
+CONTACT_CACHE_SIZE = int(os.getenv("CONTACT_CACHE_SIZE", "20000"))
+CONTACTS_CHANNEL   = "contacts_changed"
+_contact_cache = TTLCache(CONTACT_CACHE_SIZE, CONTACT_CACHE_TTL)
+_contact_epoch = 0  # bumped on every invalidation so in-flight loads don't cache stale rows
+
+# =========================
+# Metrics
+# =========================
+# Minimal Prometheus text-format metrics, served on METRICS_PORT (0 = off).
+METRICS_PORT    = int(os.getenv("METRICS_PORT", "0"))
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+_metrics: list["_Metric"] = []
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), fn=None):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.fn = fn  # optional callback returning {label values tuple: value} (or a plain number)
+        self._values: dict[tuple, float] = {}
+        _metrics.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(l, "")) for l in self.labels)
+
+    def _fmt(self, key: tuple, extra: str = "") -> str:
+        pairs = [f'{l}="{v}"' for l, v in zip(self.labels, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self):
+        values = self._values
+        if self.fn is not None:
+            got = self.fn()
+            values = got if isinstance(got, dict) else {(): got}
+        for key, value in values.items():
+            yield f"{self.name}{self._fmt(key)} {value}"
+
+    def render(self) -> str:
+        return "\n".join([f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}", *self.samples()])
+
+class CounterMetric(_Metric):
+    kind = "counter"
+
+    def inc(self, value: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + value
+
+class GaugeMetric(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+        self._series: dict[tuple, list] = {}  # key -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, **labels)
+
+    def samples(self):
+        for key, series in self._series.items():
+            for bound, n in [*zip(self.buckets, series), ("+Inf", series[-1])]:
+                le = 'le="%s"' % bound
+                yield f"{self.name}_bucket{self._fmt(key, le)} {n}"
+            yield f"{self.name}_sum{self._fmt(key)} {series[-2]}"
+            yield f"{self.name}_count{self._fmt(key)} {series[-1]}"
+
+def render_metrics() -> str:
+    return "\n".join(m.render() for m in _metrics) + "\n"
+
+handler_seconds   = Histogram("bot_handler_seconds", "Update handler latency", ("handler", "outcome"))
+handler_errors    = CounterMetric("bot_handler_errors_total", "Errors raised while handling updates")
+tg_requests       = CounterMetric("bot_telegram_requests_total", "Bot API calls", ("method", "status"))
+tg_seconds        = Histogram("bot_telegram_request_seconds", "Bot API call latency", ("method",))
+tg_retry_after    = CounterMetric("bot_telegram_retry_after_total", "Bot API calls answered with 429", ("method",))
+tg_coalesced      = CounterMetric("bot_telegram_coalesced_total", "Read calls served by an identical in-flight call", ("method",))
+tg_refused        = CounterMetric("bot_telegram_refused_total", "Update-path sends refused by the local limiter", ("method",))
+tg_limiter_wait   = Histogram("bot_telegram_limiter_wait_seconds", "Time sends waited for the rate limiter")
+db_query_seconds  = Histogram("bot_db_query_seconds", "DB helper latency, pool wait included", ("query",))
+db_pool_wait      = Histogram("bot_db_pool_wait_seconds", "Time spent waiting for a pool connection")
+db_timeouts       = CounterMetric("bot_db_timeouts_total", "Pool acquire / query timeouts", ("stage",))
+db_pool_in_use    = GaugeMetric("bot_db_pool_in_use", "Pool connections currently checked out",
+                                fn=lambda: (_pool.get_size() - _pool.get_idle_size()) if _pool else 0)
+db_pool_size      = GaugeMetric("bot_db_pool_size", "Open pool connections",
+                                fn=lambda: _pool.get_size() if _pool else 0)
+broadcast_results = CounterMetric("bot_broadcast_deliveries_total", "Broadcast deliveries by result", ("status",))
+broadcast_running = GaugeMetric("bot_broadcasts_running", "Broadcasts this process is sending",
+                                fn=lambda: len(_running_broadcasts))
+throttled_rolls   = CounterMetric("bot_throttled_rolls_total", "Dice rolls dropped by the throttle", ("scope",),
+                                  fn=lambda: {(scope,): n for scope, n in throttle_hits.items()})
+jackpot_results   = CounterMetric("bot_jackpot_events_total", "Jackpot events by outcome", ("result",))
+jackpot_queued    = GaugeMetric("bot_jackpot_queue", "Jackpot events waiting for a worker",
+                                fn=lambda: _jackpot_queue.qsize())
+duplicate_updates = CounterMetric("bot_duplicate_updates_total", "Redelivered updates dropped", ("layer",))
+chats_deactivated = CounterMetric("bot_chats_deactivated_total", "Groups marked unreachable", ("reason",))
+chats_reactivated = CounterMetric("bot_chats_reactivated_total", "Inactive groups brought back", ("reason",))
+write_behind_pending = GaugeMetric("bot_write_behind_pending", "Writes waiting to be flushed", ("queue",),
+                                   fn=lambda: {("group-titles",): len(_title_writes), ("roll-stats",): len(_roll_writes),
+                                               ("chat-health",): len(_health_writes)})
+
+def timed_handler(name: str, outcome=None):
+    """Record handler latency; `outcome(update)` can split one handler into several series."""
+    def deco(fn):
+        @functools.wraps(fn)
+        async def wrapper(update, context, *args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return await fn(update, context, *args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - t0
+                label = outcome(update) if outcome else ""
+                handler_seconds.observe(elapsed, handler=name, outcome=label)
+                if event_enabled("handler"):
+                    chat, user = update.effective_chat, update.effective_user
+                    log_event("handler", handler=name, outcome=label, ms=round(elapsed * 1000, 3),
+                              chat_id=chat.id if chat else None, user_id=user.id if user else None)
+        return wrapper
+    return deco
+
+def timed_query(name: str):
+    def deco(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with db_query_seconds.time(query=name):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return deco
+
+@contextlib.asynccontextmanager
+async def db_acquire():
+    """_pool.acquire() that records how long we queued and turns timeouts into DatabaseBusy."""
+    t0 = time.perf_counter()
+    try:
+        conn_cm = _pool.acquire(timeout=DB_ACQUIRE_TIMEOUT)
+        conn = await conn_cm.__aenter__()
+    except asyncio.TimeoutError:
+        db_timeouts.inc(stage="acquire")
+        raise DatabaseBusy("no database connection available") from None
+    db_pool_wait.observe(time.perf_counter() - t0)
+    try:
+        yield conn
+    except asyncio.TimeoutError:
+        db_timeouts.inc(stage="query")
+        await conn_cm.__aexit__(None, None, None)
+        raise DatabaseBusy("database query timed out") from None
+    except BaseException as exc:
+        await conn_cm.__aexit__(type(exc), exc, exc.__traceback__)
+        raise
+    await conn_cm.__aexit__(None, None, None)
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest that counts and times every Bot API call."""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        endpoint = url.rsplit("/", 1)[-1]
+        status = "error"
+        t0 = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+            status = str(code)
+            if code == 429:
+                tg_retry_after.inc(method=endpoint)
+            return code, payload
+        finally:
+            tg_seconds.observe(time.perf_counter() - t0, method=endpoint)
+            tg_requests.inc(method=endpoint, status=status)
+
+async def _metrics_route():
+    return "200 OK", "text/plain; version=0.0.4; charset=utf-8", render_metrics()
+
+# path -> async () -> (status line, content type, body)
+async def _ready_route():
+    if await db_ready():
+        return "200 OK", "text/plain", "ok\n"
+    return "503 Service Unavailable", "text/plain", "database unavailable\n"
+
+async def _health_route():
+    return "200 OK", "text/plain", "ok\n"
+
+HTTP_ROUTES = {"/metrics": _metrics_route, "/ready": _ready_route, "/healthz": _health_route}
+
+async def _serve_http(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+            pass  # skip headers
+        parts = request_line.decode("latin-1").split()
+        route = HTTP_ROUTES.get(parts[1].split("?")[0] if len(parts) > 1 else "")
+        if route:
+            status, ctype, body = await route()
+        else:
+            status, ctype, body = "404 Not Found", "text/plain", "not found\n"
+        data = body.encode()
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: {ctype}\r\nContent-Length: {len(data)}\r\n"
+            f"Connection: close\r\n\r\n".encode() + data
+        )
+        await writer.drain()
+    except Exception:
+        pass
+    finally:
+        writer.close()
+
+async def start_metrics_server(port: int = METRICS_PORT):
+    """Serve HTTP_ROUTES on a side port next to the webhook server."""
+    if not port:
+        return None
+    server = await asyncio.start_server(_serve_http, "0.0.0.0", port)
+    log.info("Metrics on :%s/metrics", port)
+    return server
+
+# =========================
+# Schema migrations
+# =========================
+# Append-only: never edit a migration that has shipped, add a new one.
+# Non-transactional migrations (CREATE INDEX CONCURRENTLY) must be a single statement.
+class Migration(NamedTuple):
+    version: int
+    name: str
+    sql: str
+    transactional: bool = True
+
+MIGRATIONS = [
+    Migration(1, "contacts", """
+        CREATE TABLE IF NOT EXISTS contacts (
+          chat_id  BIGINT PRIMARY KEY,
+          username TEXT,
+          user_id  BIGINT,
+          name     TEXT
+        );
+        ALTER TABLE contacts ADD COLUMN IF NOT EXISTS paid BOOLEAN NOT NULL DEFAULT FALSE;
+        ALTER TABLE contacts ADD COLUMN IF NOT EXISTS group_title TEXT;
+    """),
+    # tell every replica when a contact changes so they can drop their cached copy
+    Migration(2, "contacts_changed trigger", f"""
+        CREATE OR REPLACE FUNCTION notify_contacts_changed() RETURNS trigger AS $$
+        BEGIN
+          PERFORM pg_notify('{CONTACTS_CHANNEL}',
+            COALESCE(NEW.chat_id, OLD.chat_id)::text || ':' || current_setting('application_name', true));
+          RETURN NULL;
+        END $$ LANGUAGE plpgsql;
+        DROP TRIGGER IF EXISTS contacts_changed ON contacts;
+        CREATE TRIGGER contacts_changed
+          AFTER INSERT OR DELETE OR UPDATE OF username, user_id, name, paid ON contacts
+          FOR EACH ROW EXECUTE FUNCTION notify_contacts_changed();
+    """),
+    # roll statistics: per (chat, user, day) buckets plus running per-user totals
+    Migration(3, "roll stats", """
+        CREATE TABLE IF NOT EXISTS roll_stats (
+          chat_id  BIGINT NOT NULL,
+          user_id  BIGINT NOT NULL,
+          day      DATE   NOT NULL,
+          rolls    INT    NOT NULL DEFAULT 0,
+          jackpots INT    NOT NULL DEFAULT 0,
+          triples  INT    NOT NULL DEFAULT 0,
+          PRIMARY KEY (chat_id, user_id, day)
+        );
+        CREATE INDEX IF NOT EXISTS roll_stats_chat_day ON roll_stats (chat_id, day);
+        CREATE TABLE IF NOT EXISTS roll_totals (
+          chat_id  BIGINT NOT NULL,
+          user_id  BIGINT NOT NULL,
+          username TEXT,  -- display name: @username or full name
+          rolls    BIGINT NOT NULL DEFAULT 0,
+          jackpots BIGINT NOT NULL DEFAULT 0,
+          triples  BIGINT NOT NULL DEFAULT 0,
+          PRIMARY KEY (chat_id, user_id)
+        );
+        CREATE INDEX IF NOT EXISTS roll_totals_leaderboard
+            ON roll_totals (chat_id, jackpots DESC, rolls DESC);
+    """),
+    # /sendad outbox: one row per broadcast, one row per (broadcast, chat) delivery
+    Migration(4, "broadcast outbox", """
+        CREATE TABLE IF NOT EXISTS broadcasts (
+          id             BIGSERIAL PRIMARY KEY,
+          text           TEXT NOT NULL,
+          status         TEXT NOT NULL DEFAULT 'running',  -- running | done | cancelled
+          total          INT  NOT NULL DEFAULT 0,
+          reported       INT  NOT NULL DEFAULT 0,
+          report_chat_id BIGINT,
+          created_at     TIMESTAMPTZ NOT NULL DEFAULT now(),
+          finished_at    TIMESTAMPTZ
+        );
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+          broadcast_id BIGINT NOT NULL REFERENCES broadcasts(id) ON DELETE CASCADE,
+          chat_id      BIGINT NOT NULL,
+          status       TEXT NOT NULL DEFAULT 'pending',  -- pending | sending | sent | skipped | failed | cancelled
+          attempts     INT  NOT NULL DEFAULT 0,
+          error        TEXT,
+          claimed_at   TIMESTAMPTZ,
+          PRIMARY KEY (broadcast_id, chat_id)
+        );
+        CREATE INDEX IF NOT EXISTS broadcast_deliveries_open
+            ON broadcast_deliveries (broadcast_id, chat_id)
+            WHERE status IN ('pending', 'sending');
+    """),
+    # unpaid segment / create_broadcast: only the unpaid rows, without locking out writers
+    Migration(5, "unpaid contacts index", """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS contacts_unpaid ON contacts (chat_id) WHERE NOT paid
+    """, transactional=False),
+    # small key/value store, e.g. the hash of the last set_my_commands payload
+    Migration(6, "bot settings", """
+        CREATE TABLE IF NOT EXISTS bot_settings (
+          key   TEXT PRIMARY KEY,
+          value TEXT NOT NULL
+        )
+    """),
+    # paid segment: count_segment and the INSERT ... SELECT in create_broadcast (unpaid has contacts_unpaid)
+    Migration(7, "paid contacts index", """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS contacts_paid ON contacts (chat_id) WHERE paid
+    """, transactional=False),
+    # delivery health: consecutive send failures per group, inactive once over the limit
+    Migration(8, "contact delivery health", """
+        ALTER TABLE contacts ADD COLUMN IF NOT EXISTS active          BOOLEAN NOT NULL DEFAULT TRUE;
+        ALTER TABLE contacts ADD COLUMN IF NOT EXISTS fail_kind       TEXT;
+        ALTER TABLE contacts ADD COLUMN IF NOT EXISTS fail_count      INT NOT NULL DEFAULT 0;
+        ALTER TABLE contacts ADD COLUMN IF NOT EXISTS last_failure_at TIMESTAMPTZ;
+        ALTER TABLE contacts ADD COLUMN IF NOT EXISTS deactivated_at  TIMESTAMPTZ;
+    """),
+    # jackpot outbox (PK doubles as dedupe of redelivered updates) + extra notifiers per group
+    Migration(9, "jackpot events", """
+        CREATE TABLE IF NOT EXISTS jackpot_events (
+          chat_id    BIGINT NOT NULL,
+          message_id BIGINT NOT NULL,
+          user_id    BIGINT,
+          username   TEXT,
+          thread_id  BIGINT,
+          status     TEXT NOT NULL DEFAULT 'pending',  -- pending | sending | done
+          announced  BOOLEAN NOT NULL DEFAULT FALSE,
+          attempts   INT  NOT NULL DEFAULT 0,
+          claimed_by TEXT,
+          claimed_at TIMESTAMPTZ,
+          created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+          PRIMARY KEY (chat_id, message_id)
+        );
+        CREATE INDEX IF NOT EXISTS jackpot_events_open
+            ON jackpot_events (created_at) WHERE status <> 'done';
+        CREATE TABLE IF NOT EXISTS jackpot_notifiers (
+          chat_id    BIGINT NOT NULL,
+          user_id    BIGINT NOT NULL,
+          created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+          PRIMARY KEY (chat_id, user_id)
+        );
+    """),
+    # update_id dedup shared by replicas (UPDATE_DEDUP_DB=1)
+    Migration(10, "processed updates", """
+        CREATE TABLE IF NOT EXISTS processed_updates (
+          update_id BIGINT PRIMARY KEY,
+          seen_at   TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        CREATE INDEX IF NOT EXISTS processed_updates_seen_at ON processed_updates (seen_at);
+    """),
+    # notifiers already DMed for an event, so a retry doesn't DM them again;
+    # status 'failed' for events that ran out of attempts
+    Migration(11, "jackpot delivery tracking", """
+        ALTER TABLE jackpot_events ADD COLUMN IF NOT EXISTS notified BIGINT[] NOT NULL DEFAULT '{}';
+        DROP INDEX IF EXISTS jackpot_events_open;
+        CREATE INDEX IF NOT EXISTS jackpot_events_open
+            ON jackpot_events (created_at) WHERE status IN ('pending', 'sending');
+    """),
+    # who a broadcast went to, for its summary ("unpaid", "active (last 7 days)", ...)
+    Migration(12, "broadcast audience", """
+        ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS audience TEXT NOT NULL DEFAULT 'unpaid';
+    """),
+]
+SCHEMA_VERSION = MIGRATIONS[-1].version
+MIGRATION_LOCK = 0x526f756c  # pg_advisory_lock key, any constant shared by all replicas
+MIGRATION_LOCK_POLL = 0.5      # seconds between pg_try_advisory_lock attempts
+
+async def _drop_invalid_index(conn, sql: str):
+    """A failed CREATE INDEX CONCURRENTLY leaves an INVALID index behind that
+    IF NOT EXISTS would skip forever; drop it so the migration builds it again."""
+    m = re.search(r"CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+IF\s+NOT\s+EXISTS\s+(\w+)", sql, re.I)
+    if not m:
+        return
+    invalid = await conn.fetchval(
+        "SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass($1)", m.group(1))
+    if invalid:
+        log.warning("Dropping invalid index %s left by an earlier attempt", m.group(1))
+        await conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {m.group(1)}")
+
+async def _schema_version(conn) -> int:
+    try:
+        return await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    except asyncpg.UndefinedTableError:
+        return 0
+
+async def migrate(conn):
+    """Bring the schema up to SCHEMA_VERSION. Usually just one SELECT."""
+    if await _schema_version(conn) >= SCHEMA_VERSION:
+        return
+    # one replica migrates, the others wait here and then find nothing left to do.
+    # Poll instead of blocking in pg_advisory_lock: a waiting statement holds a
+    # snapshot, and CREATE INDEX CONCURRENTLY would wait for it while it waits for us.
+    while not await conn.fetchval("SELECT pg_try_advisory_lock($1)", MIGRATION_LOCK):
+        await asyncio.sleep(MIGRATION_LOCK_POLL)
+    try:
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+              version    INT PRIMARY KEY,
+              name       TEXT NOT NULL,
+              applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            )
+        """)
+        current = await _schema_version(conn)
+        for m in MIGRATIONS:
+            if m.version <= current:
+                continue
+            log.info("Applying migration %d: %s", m.version, m.name)
+            if m.transactional:
+                async with conn.transaction():
+                    await conn.execute(m.sql)
+                    await conn.execute("INSERT INTO schema_version (version, name) VALUES ($1, $2)",
+                                       m.version, m.name)
+            else:
+                await _drop_invalid_index(conn, m.sql)
+                await conn.execute(m.sql)
+                await conn.execute("INSERT INTO schema_version (version, name) VALUES ($1, $2)",
+                                   m.version, m.name)
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATION_LOCK)
+
+# =========================
+# DB helpers
+# =========================
+DB_POOL_MIN         = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX         = int(os.getenv("DB_POOL_MAX", "5"))
+DB_COMMAND_TIMEOUT  = float(os.getenv("DB_COMMAND_TIMEOUT", "5"))   # per query
+DB_ACQUIRE_TIMEOUT  = float(os.getenv("DB_ACQUIRE_TIMEOUT", "2"))   # waiting for a free connection
+DB_IDLE_LIFETIME    = float(os.getenv("DB_IDLE_LIFETIME", "300"))   # close connections idle this long
+
+# Hot-path statements, prepared once per connection by _init_connection
+HOT_SQL = {
+    # contact + paid lookup (one row feeds both caches)
+    "contact": "SELECT username, user_id, name, paid FROM contacts WHERE chat_id=$1",
+    "titles": """
+      INSERT INTO contacts (chat_id, group_title)
+      SELECT * FROM UNNEST($1::bigint[], $2::text[])
+      ON CONFLICT (chat_id) DO UPDATE SET group_title = EXCLUDED.group_title
+      WHERE contacts.group_title IS DISTINCT FROM EXCLUDED.group_title
+    """,
+}
+
+class DatabaseBusy(RuntimeError):
+    """No pool connection within DB_ACQUIRE_TIMEOUT, or a query ran past DB_COMMAND_TIMEOUT."""
+
+class BotConnection(asyncpg.Connection):
+    """Pool connection that carries its prepared hot-path statements in `stmts`."""
+
+async def _init_connection(conn: BotConnection):
+    conn.stmts = {name: await conn.prepare(sql) for name, sql in HOT_SQL.items()}
+
 async def init_db():
     """Called once on startup (you already do asyncio.run(init_db()))."""
     global _pool
     if not DB_URL:
         raise RuntimeError("Missing DATABASE_URL")
-    _pool = await asyncpg.create_pool(DB_URL, min_size=1, max_size=5)
-    async with _pool.acquire() as conn:
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS contacts (
-              chat_id  BIGINT PRIMARY KEY,
-              username TEXT,
-              user_id  BIGINT,
-              name     TEXT
-            )
-        """)
-        # after CREATE TABLE IF NOT EXISTS contacts (...)
-        await conn.execute("""
-                           ALTER TABLE contacts
-                               ADD COLUMN IF NOT EXISTS paid BOOLEAN NOT NULL DEFAULT FALSE
-                           """)
-        await conn.execute("""
-                           ALTER TABLE contacts
-                               ADD COLUMN IF NOT EXISTS group_title TEXT
-                           """)
+    # schema first, on its own connection: the pool prepares statements against these tables
+    conn = await asyncpg.connect(DB_URL)
+    try:
+        await migrate(conn)
+    finally:
+        await conn.close()
+    _pool = await asyncpg.create_pool(
+        DB_URL,
+        min_size=DB_POOL_MIN,
+        max_size=DB_POOL_MAX,
+        command_timeout=DB_COMMAND_TIMEOUT,
+        max_inactive_connection_lifetime=DB_IDLE_LIFETIME,
+        connection_class=BotConnection,
+        init=_init_connection,
+        server_settings={"application_name": BOT_INSTANCE},
+    )
+
+async def db_ready(timeout: float = 2) -> bool:
+    """Readiness: can we get a connection and run a query quickly?"""
+    if _pool is None:
+        return False
+    try:
+        async with db_acquire() as conn:
+            await conn.fetchval("SELECT 1", timeout=timeout)
+        return True
+    except Exception:
+        return False
 
+def _contact_record(row) -> ContactRecord:
+    if not row:
+        return _NO_CONTACT
+    return ContactRecord(True, row["username"], row["user_id"], row["name"], bool(row["paid"]))
+
+def invalidate_contact(chat_id: int | None = None):
+    global _contact_epoch
+    _contact_epoch += 1
+    if chat_id is None:
+        _contact_cache.clear()
+    else:
+        _contact_cache.pop(chat_id)
+
+async def load_contact(chat_id: int) -> ContactRecord:
+    """Cached contacts row for `chat_id` (_NO_CONTACT when there is none)."""
+    rec = _contact_cache.get(chat_id)
+    if rec is not None:
+        return rec
+    epoch = _contact_epoch
+    # timed here rather than with @timed_query, so cache hits don't drown out the DB latency
+    with db_query_seconds.time(query="load_contact"):
+        async with db_acquire() as conn:
+            row = await conn.stmts["contact"].fetchrow(chat_id)
+    rec = _contact_record(row)
+    if epoch == _contact_epoch:
+        _contact_cache.set(chat_id, rec)
+    return rec
+
+@timed_query("set_contact_db")
 async def set_contact_db(chat_id: int, username: str | None, user_id: int | None, name: str | None):
-    async with _pool.acquire() as conn:
-        await conn.execute("""
+    async with db_acquire() as conn:
+        row = await conn.fetchrow("""
           INSERT INTO contacts (chat_id, username, user_id, name)
           VALUES ($1, $2, $3, $4)
           ON CONFLICT (chat_id) DO UPDATE SET
             username = EXCLUDED.username,
             user_id  = EXCLUDED.user_id,
             name     = EXCLUDED.name
+          RETURNING username, user_id, name, paid
         """, chat_id, username, user_id, name)
+    invalidate_contact(chat_id)
+    _contact_cache.set(chat_id, _contact_record(row))
 
 async def get_contact_db(chat_id: int):
-    async with _pool.acquire() as conn:
-        row = await conn.fetchrow(
-            "SELECT username, user_id, name FROM contacts WHERE chat_id=$1", chat_id
-        )
-        return (row["username"], row["user_id"], row["name"]) if row else None
+    rec = await load_contact(chat_id)
+    return (rec.username, rec.user_id, rec.name) if rec.exists else None
 
+@timed_query("unset_contact_db")
 async def unset_contact_db(chat_id: int):
-    async with _pool.acquire() as conn:
+    async with db_acquire() as conn:
         await conn.execute("DELETE FROM contacts WHERE chat_id=$1", chat_id)
+    invalidate_contact(chat_id)
+    _contact_cache.set(chat_id, _NO_CONTACT)
+    _title_cache.pop(chat_id)  # the title went with the row
+
+def _on_contacts_notify(conn, pid, channel, payload: str):
+    chat_id, _, origin = payload.partition(":")
+    if origin != BOT_INSTANCE:
+        invalidate_contact(int(chat_id))
+
+async def contacts_listener(heartbeat: float = 30):
+    """Hold a LISTEN connection for contacts_changed and admins_changed; drop both
+    caches whenever it (re)connects."""
+    while True:
+        conn = None
+        try:
+            conn = await asyncpg.connect(DB_URL)
+            await conn.add_listener(CONTACTS_CHANNEL, _on_contacts_notify)
+            await conn.add_listener(ADMINS_CHANNEL, _on_admins_notify)
+            # anything could have changed while we weren't listening
+            invalidate_contact()
+            _admin_cache.clear()
+            while True:
+                await asyncio.sleep(heartbeat)
+                await conn.execute("SELECT 1", timeout=10)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.warning("contacts listener lost its connection, reconnecting", exc_info=True)
+        finally:
+            invalidate_contact()
+            _admin_cache.clear()
+            if conn is not None and not conn.is_closed():
+                conn.terminate()
+        await asyncio.sleep(5)
 
 # =========================
 # Admin check
 # =========================
+ADMIN_STATUSES   = ("creator", "administrator")
+ADMIN_CACHE_TTL  = float(os.getenv("ADMIN_CACHE_TTL", "600"))
+ADMIN_CACHE_SIZE = int(os.getenv("ADMIN_CACHE_SIZE", "10000"))
+ADMINS_CHANNEL   = "admins_changed"
+# Telegram's default update types plus the opt-in chat_member; the reaction
+# updates stay off, nothing handles them and busy groups send plenty
+ALLOWED_UPDATES = [t for t in Update.ALL_TYPES
+                   if t not in (Update.MESSAGE_REACTION, Update.MESSAGE_REACTION_COUNT)]
+# chat_id -> set of admin user_ids, seeded in bulk from get_chat_administrators
+# and kept current by chat_member updates (see on_chat_member). Telegram only
+# sends those to admins, so only groups where the bot is an admin are cached;
+# other replicas drop their copy on the admins_changed NOTIFY.
+_admin_cache = TTLCache(ADMIN_CACHE_SIZE, ADMIN_CACHE_TTL)
+
+async def get_chat_admins(bot, chat_id: int) -> set[int] | None:
+    """Admin user_ids of `chat_id`, or None if Telegram won't list them."""
+    admins = _admin_cache.get(chat_id)
+    if admins is not None:
+        return admins
+    try:
+        members = await bot.get_chat_administrators(chat_id)
+    except (BadRequest, Forbidden):
+        return None
+    admins = {m.user.id for m in members if m.status in ADMIN_STATUSES}
+    # without admin rights no chat_member updates would tell us about a demotion,
+    # so only this call gets to use the list
+    if bot.id in admins:
+        _admin_cache.set(chat_id, admins)
+    return admins
+
+async def publish_admin_change(chat_id: int):
+    """Tell the other replicas to drop their cached admins of `chat_id`."""
+    try:
+        async with db_acquire() as conn:
+            await conn.execute("SELECT pg_notify($1, $2)", ADMINS_CHANNEL, f"{chat_id}:{BOT_INSTANCE}")
+    except Exception:
+        log.warning("Could not publish admin change for %s", chat_id, exc_info=True)
+
+def _on_admins_notify(conn, pid, channel, payload: str):
+    chat_id, _, origin = payload.partition(":")
+    if origin != BOT_INSTANCE:
+        _admin_cache.pop(int(chat_id))
+
 async def is_admin(update: Update, context: ContextTypes.DEFAULT_TYPE, target_chat_id: int | None = None) -> bool:
     chat = update.effective_chat
     msg  = update.effective_message
@@ -90,26 +928,980 @@ async def is_admin(update: Update, context: ContextTypes.DEFAULT_TYPE, target_ch
     if not cid or not user:
         return False
 
+    admins = await get_chat_admins(context.bot, cid)
+    if admins is not None:
+        return user.id in admins
+
+    # couldn't list admins (e.g. not a group) — ask about this one user
     member = await context.bot.get_chat_member(cid, user.id)
-    return member.status in ("creator", "administrator")
+    return member.status in ADMIN_STATUSES
+
+@timed_handler("chat_member")
+async def on_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Keep the admin cache in sync with promotions, demotions and leaves."""
+    if update.my_chat_member:
+        # our own rights changed: we may stop receiving chat_member updates, so start fresh
+        mcm = update.my_chat_member
+        _admin_cache.pop(mcm.chat.id)
+        if (mcm.old_chat_member.status in ADMIN_STATUSES) != (mcm.new_chat_member.status in ADMIN_STATUSES):
+            await publish_admin_change(mcm.chat.id)
+        if mcm.chat.type != "private":
+            new = mcm.new_chat_member
+            if new.status in GONE_STATUSES:
+                if mcm.old_chat_member.status not in GONE_STATUSES:
+                    if await set_chat_active(mcm.chat.id, False):
+                        chats_deactivated.inc(reason="left")
+            elif new.status != "restricted" or new.can_send_messages:
+                # re-added, unmuted or promoted: whatever deactivated the group is over
+                if await set_chat_active(mcm.chat.id, True):
+                    chats_reactivated.inc(reason="member")
+        return
+
+    cmu = update.chat_member
+    promoted = cmu.new_chat_member.status in ADMIN_STATUSES
+    if promoted == (cmu.old_chat_member.status in ADMIN_STATUSES):
+        return  # joins, leaves and restrictions of regular members
+    admins = _admin_cache.get(cmu.chat.id)
+    if admins is not None:
+        if promoted:
+            admins.add(cmu.new_chat_member.user.id)
+        else:
+            admins.discard(cmu.new_chat_member.user.id)
+    await publish_admin_change(cmu.chat.id)
+
+# =========================
+# Segments
+# =========================
+# Named sets of groups (unpaid, paid, active in the last N days). A segment is
+# only ever expanded inside Postgres: create_broadcast() copies it into
+# broadcast_deliveries with INSERT ... SELECT and run_broadcast() claims those
+# rows in batches, so the group list is never loaded into the bot.
+SEGMENTS            = ("unpaid", "paid", "active")
+SEGMENT_ACTIVE_DAYS = int(os.getenv("SEGMENT_ACTIVE_DAYS", "7"))
+
+def segment_filter(segment: str, days: int | None = None, arg: int = 1) -> tuple[str, list]:
+    """WHERE clause over `contacts c` for `segment`, its parameters numbered from $arg.
+
+    Groups marked inactive (see Chat health) are never part of a segment.
+    """
+    if segment == "unpaid":
+        return "NOT c.paid AND c.active", []
+    if segment == "paid":
+        return "c.paid AND c.active", []
+    if segment == "active":
+        days = min(days or SEGMENT_ACTIVE_DAYS, MAX_DAYS)
+        since = datetime.now(timezone.utc).date() - timedelta(days=days - 1)
+        return (f"c.active AND EXISTS (SELECT 1 FROM roll_stats s WHERE s.chat_id = c.chat_id AND s.day >= ${arg})",
+                [since])
+    raise ValueError(f"unknown segment {segment!r}")
+
+def segment_label(segment: str, days: int | None = None) -> str:
+    if segment == "active":
+        return f"active (last {days or SEGMENT_ACTIVE_DAYS} days)"
+    return segment
+
+@timed_query("count_segment")
+async def count_segment(segment: str, days: int | None = None) -> int:
+    if segment == "active":
+        await _roll_writes.flush()
+    where, args = segment_filter(segment, days)
+    async with db_acquire() as conn:
+        return await conn.fetchval(f"SELECT count(*) FROM contacts c WHERE {where}", *args)
+
+# =========================
+# Chat health
+# =========================
+# Sends to a group feed back into contacts: failures that mean "we can't reach
+# this chat" are counted, a success resets the count, and a group goes inactive
+# (dropped from every segment) once its count reaches the limit for that kind.
+# Leaving/being kicked (my_chat_member) deactivates at once. A group comes back
+# when a later send to it succeeds (e.g. a jackpot reply after the bot was
+# unmuted), unless it was deactivated as forbidden/left, or when my_chat_member
+# shows the bot re-added or allowed to post again.
+CHAT_FAIL_LIMITS = {
+    "forbidden": int(os.getenv("CHAT_FORBIDDEN_LIMIT", "1")),   # kicked / removed
+    "not_found": int(os.getenv("CHAT_NOT_FOUND_LIMIT", "3")),   # chat deleted or upgraded
+    "no_rights": int(os.getenv("CHAT_NO_RIGHTS_LIMIT", "5")),   # muted / can't post
+}
+GONE_STATUSES = ("left", "kicked")
+REVIVABLE_KINDS = ("not_found", "no_rights")  # a successful send proves these wrong
+
+def failure_kind(ex: Exception) -> str | None:
+    """Map a send error to a CHAT_FAIL_LIMITS kind, or None if it says nothing about the chat."""
+    if isinstance(ex, Forbidden):
+        return "forbidden"
+    if isinstance(ex, BadRequest):
+        msg = ex.message.lower()
+        if "chat not found" in msg or "group chat was deactivated" in msg:
+            return "not_found"
+        if "not enough rights" in msg or "have no rights" in msg or "chat_write_forbidden" in msg:
+            return "no_rights"
+    return None
+
+# value: (reset, failures, kind) — reset = a success happened before these failures
+def _merge_health(old: tuple, new: tuple) -> tuple:
+    if new[0]:
+        return new
+    return old[0], old[1] + new[1], new[2] or old[2]
+
+def note_chat_ok(chat_id: int):
+    _health_writes.put(chat_id, (True, 0, None))
+
+def note_chat_failure(chat_id: int, ex: Exception):
+    kind = failure_kind(ex)
+    if kind:
+        _health_writes.put(chat_id, (False, 1, kind))
+
+@timed_query("store_chat_health")
+async def store_chat_health(batch: dict[int, tuple]):
+    chat_ids = list(batch)
+    async with db_acquire() as conn:
+        async with conn.transaction():
+            # only a clean success revives; a send refused as forbidden needs the bot re-added
+            revived = await conn.fetch("""
+                UPDATE contacts c SET active=TRUE, fail_count=0, fail_kind=NULL, deactivated_at=NULL
+                FROM UNNEST($1::bigint[], $2::bool[], $3::int[]) AS u(chat_id, reset, failures)
+                WHERE c.chat_id = u.chat_id AND NOT c.active AND u.reset AND u.failures = 0
+                  AND c.fail_kind = ANY($4::text[])
+                RETURNING c.chat_id, c.fail_kind
+            """, chat_ids, [batch[c][0] for c in chat_ids], [batch[c][1] for c in chat_ids],
+                list(REVIVABLE_KINDS))
+            rows = await conn.fetch("""
+                UPDATE contacts c SET
+                  fail_count      = CASE WHEN u.reset THEN 0 ELSE c.fail_count END + u.failures,
+                  fail_kind       = CASE WHEN u.failures > 0 THEN u.kind
+                                         WHEN u.reset THEN NULL ELSE c.fail_kind END,
+                  last_failure_at = CASE WHEN u.failures > 0 THEN now() ELSE c.last_failure_at END
+                FROM UNNEST($1::bigint[], $2::bool[], $3::int[], $4::text[]) AS u(chat_id, reset, failures, kind)
+                WHERE c.chat_id = u.chat_id AND c.active AND (u.failures > 0 OR c.fail_count > 0)
+                RETURNING c.chat_id, c.fail_count, c.fail_kind
+            """, chat_ids, [batch[c][0] for c in chat_ids], [batch[c][1] for c in chat_ids],
+                [batch[c][2] for c in chat_ids])
+            dead = [r for r in rows if r["fail_kind"] and r["fail_count"] >= CHAT_FAIL_LIMITS[r["fail_kind"]]]
+            if dead:
+                await conn.execute("""
+                    UPDATE contacts SET active=FALSE, deactivated_at=now() WHERE chat_id = ANY($1::bigint[])
+                """, [r["chat_id"] for r in dead])
+    for r in revived:
+        chats_reactivated.inc(reason="send")
+        log.info("Chat %s active again: a send succeeded", r["chat_id"])
+    for r in dead:
+        chats_deactivated.inc(reason=r["fail_kind"])
+        log.info("Chat %s marked inactive after %d x %s", r["chat_id"], r["fail_count"], r["fail_kind"])
+
+_health_writes = WriteBehind("chat-health", store_chat_health, merge=_merge_health)
+
+@timed_query("set_chat_active")
+async def set_chat_active(chat_id: int, active: bool) -> bool:
+    """Membership changed: deactivate now, or reactivate with a clean slate. True if the row changed."""
+    async with db_acquire() as conn:
+        if active:
+            res = await conn.execute("""
+                UPDATE contacts SET active=TRUE, fail_count=0, fail_kind=NULL, deactivated_at=NULL
+                WHERE chat_id=$1 AND NOT active
+            """, chat_id)
+        else:
+            res = await conn.execute("""
+                UPDATE contacts SET active=FALSE, fail_kind='left', deactivated_at=now()
+                WHERE chat_id=$1 AND active
+            """, chat_id)
+    return res.endswith(" 1")
+
+# =========================
+# Rate limiting
+# =========================
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, bursts up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self._tokens = self.capacity
+        self._stamp = time.monotonic()
+        self._paused_until = 0.0
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        now = time.monotonic()
+        if now < self._paused_until:
+            return False
+        self._refill(now)
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return True
+        return False
+
+    async def acquire(self, tokens: float = 1):
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._refill(now)
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return
+            await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+    def retry_in(self, tokens: float = 1) -> float:
+        """Seconds until `tokens` would be available (0 = now)."""
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+        self._refill(now)
+        return max(0.0, (tokens - self._tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """Stop handing out tokens for `seconds` (e.g. after a RetryAfter)."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+class RateLimiter:
+    """Global token bucket plus one token bucket per chat.
+
+    Private chats (positive ids) can get their own per-chat rate and burst.
+    """
+
+    def __init__(self, rate: float, chat_rate: float, chat_burst: float = 1,
+                 private_rate: float | None = None, private_burst: float | None = None,
+                 max_chats: int = 100_000):
+        self.bucket = TokenBucket(rate)
+        self.chat_rate, self.chat_burst = chat_rate, chat_burst
+        self.private_rate = private_rate or chat_rate
+        self.private_burst = private_burst or chat_burst
+        self._chats = TTLCache(max_chats, 60)
+
+    def chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if isinstance(chat_id, int) and chat_id > 0:
+                bucket = TokenBucket(self.private_rate, self.private_burst)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+        # once it has had time to refill completely it is as good as new, so it may be evicted
+        self._chats.set(chat_id, bucket, ttl=bucket.capacity / bucket.rate + 1)
+        return bucket
+
+    async def acquire(self, chat_id=None, shared: bool = True):
+        """Wait for a token of `chat_id` and, if `shared`, one of the global bucket."""
+        if chat_id is not None:
+            await self.chat_bucket(chat_id).acquire()
+        if shared:
+            await self.bucket.acquire()
+
+    def pause(self, seconds: float, chat_id=None):
+        """Hold everything (or just `chat_id`) for `seconds`, e.g. after a RetryAfter."""
+        (self.bucket if chat_id is None else self.chat_bucket(chat_id)).pause(seconds)
 
-async def list_unpaid_groups():
-    async with _pool.acquire() as conn:
+# =========================
+# Outbound Bot API client
+# =========================
+# Every Bot API call goes through TelegramRequest: HTTP/2 with a tuned keep-alive
+# pool, identical in-flight read calls collapsed into one, and sends paced by a
+# central RateLimiter so handlers don't run into Telegram's flood control.
+# The limiter lives in the process: sharded workers set BROADCAST_GLOBAL_RATE
+# aside for the broadcast sender and split the rest of TG_GLOBAL_RATE, but
+# separate replicas of the bot don't know about each other, so with R replicas
+# set TG_GLOBAL_RATE to about 30 / R on each.
+TG_HTTP_VERSION     = os.getenv("TG_HTTP_VERSION", "2")
+TG_POOL_SIZE        = int(os.getenv("TG_POOL_SIZE", "32"))
+TG_KEEPALIVE_EXPIRY = float(os.getenv("TG_KEEPALIVE_EXPIRY", "60"))
+TG_GLOBAL_RATE      = float(os.getenv("TG_GLOBAL_RATE", "30"))
+TG_GROUP_RATE       = float(os.getenv("TG_GROUP_RATE", str(20 / 60)))  # ~20 msg/min per group
+TG_GROUP_BURST      = float(os.getenv("TG_GROUP_BURST", "10"))
+TG_PRIVATE_RATE     = float(os.getenv("TG_PRIVATE_RATE", "1"))
+TG_PRIVATE_BURST    = float(os.getenv("TG_PRIVATE_BURST", "3"))
+TG_MAX_429_RETRIES  = int(os.getenv("TG_MAX_429_RETRIES", "2"))
+TG_UPDATE_MAX_WAIT  = float(os.getenv("TG_UPDATE_MAX_WAIT", "0.25"))  # longest an update-path send waits on the global bucket
+COALESCED_METHODS = frozenset({
+    "getMe", "getChat", "getChatMember", "getChatAdministrators", "getChatMemberCount", "getMyCommands",
+})
+RATE_LIMITED_PREFIXES = ("send", "copy", "forward", "edit")
+
+def _retry_after(payload: bytes) -> float:
+    try:
+        return float(json.loads(payload)["parameters"]["retry_after"])
+    except Exception:
+        return 1.0
+
+# Updates are processed one at a time, so a send made while handling one must
+# never sleep on a chat bucket or a 429: every other chat would queue behind it.
+# Only background senders (broadcasts, jackpot workers) set this and wait.
+background_sends: contextvars.ContextVar[bool] = contextvars.ContextVar("background_sends", default=False)
+# Set by run_broadcast, which paces itself on _broadcast_limiter.
+broadcast_sends: contextvars.ContextVar[bool] = contextvars.ContextVar("broadcast_sends", default=False)
+
+def _too_many_requests(retry_after: float) -> bytes:
+    """429 body for a send the local limiter refused; PTB raises it as RetryAfter."""
+    seconds = max(1, int(retry_after + 0.999))
+    return json.dumps({
+        "ok": False, "error_code": 429,
+        "description": f"Too Many Requests: retry after {seconds} (local limit)",
+        "parameters": {"retry_after": seconds},
+    }).encode()
+
+class TelegramRequest(InstrumentedRequest):
+    """InstrumentedRequest with request coalescing and central rate limiting."""
+
+    def __init__(self, limiter: RateLimiter | None = None, broadcast_share: bool = False, **kwargs):
+        pool_size = kwargs.setdefault("connection_pool_size", TG_POOL_SIZE)
+        kwargs.setdefault("http_version", TG_HTTP_VERSION)
+        kwargs.setdefault("httpx_kwargs", {"limits": httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
+            keepalive_expiry=TG_KEEPALIVE_EXPIRY,
+        )})
+        try:
+            super().__init__(**kwargs)
+        except RuntimeError:
+            # h2 isn't installed
+            if kwargs["http_version"] == "1.1":
+                raise
+            log.warning("HTTP/2 unavailable (install python-telegram-bot[http2]), using HTTP/1.1")
+            kwargs["http_version"] = "1.1"
+            super().__init__(**kwargs)
+        self.limiter = limiter or RateLimiter(
+            TG_GLOBAL_RATE, TG_GROUP_RATE, TG_GROUP_BURST, TG_PRIVATE_RATE, TG_PRIVATE_BURST,
+        )
+        # broadcasts have their own share of the bot's rate (sharded workers), so
+        # their sends don't take tokens from the global bucket
+        self.broadcast_share = broadcast_share
+        self._inflight: dict[tuple, asyncio.Future] = {}
+
+    async def do_request(self, url: str, method: str, request_data=None, *args, **kwargs):
+        endpoint = url.rsplit("/", 1)[-1]
+        if endpoint in COALESCED_METHODS:
+            return await self._coalesced(url, method, request_data, *args, **kwargs)
+        if endpoint.startswith(RATE_LIMITED_PREFIXES):
+            return await self._rate_limited(url, method, request_data, *args, **kwargs)
+        return await super().do_request(url, method, request_data, *args, **kwargs)
+
+    async def _coalesced(self, url, method, request_data, *args, **kwargs):
+        params = request_data.json_parameters if request_data else {}
+        key = (url, tuple(sorted(params.items())))
+        fut = self._inflight.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(super().do_request(url, method, request_data, *args, **kwargs))
+            self._inflight[key] = fut
+            fut.add_done_callback(lambda f: self._done(key, f))
+        else:
+            tg_coalesced.inc(method=url.rsplit("/", 1)[-1])
+        # shield: one caller giving up must not cancel the call for everyone else
+        return await asyncio.shield(fut)
+
+    def _done(self, key, fut: asyncio.Future):
+        self._inflight.pop(key, None)
+        if not fut.cancelled():
+            fut.exception()  # mark retrieved even if every waiter went away
+
+    async def _rate_limited(self, url, method, request_data, *args, **kwargs):
+        chat_id = request_data.parameters.get("chat_id") if request_data else None
+        if not background_sends.get():
+            return await self._update_send(url, method, request_data, chat_id, *args, **kwargs)
+        retries = 0 if request_data and request_data.multipart_data else TG_MAX_429_RETRIES
+        shared = not (self.broadcast_share and broadcast_sends.get())
+        for attempt in range(retries + 1):
+            with tg_limiter_wait.time():
+                await self.limiter.acquire(chat_id, shared)
+            code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+            if code != 429 or attempt == retries:
+                return code, payload
+            # flood control: hold this chat (or everything, if the call had no chat) and try again
+            self.limiter.pause(_retry_after(payload) + 0.5, chat_id)
+
+    async def _update_send(self, url, method, request_data, chat_id, *args, **kwargs):
+        """Send from the update path: refuse instead of waiting, never retry."""
+        endpoint = url.rsplit("/", 1)[-1]
+        # global check first: a send refused there must not spend the chat's token
+        wait = self.limiter.bucket.retry_in()
+        if wait > TG_UPDATE_MAX_WAIT:
+            tg_refused.inc(method=endpoint)
+            return 429, _too_many_requests(wait)
+        if chat_id is not None:
+            bucket = self.limiter.chat_bucket(chat_id)
+            if not bucket.try_acquire():
+                tg_refused.inc(method=endpoint)
+                return 429, _too_many_requests(bucket.retry_in())
+        with tg_limiter_wait.time():
+            await self.limiter.bucket.acquire()
+        code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+        if code == 429:
+            self.limiter.pause(_retry_after(payload) + 0.5, chat_id)
+        return code, payload
+
+# =========================
+# Broadcast engine
+# =========================
+# Telegram allows ~30 msg/s across all chats and ~20 msg/min inside one group.
+BROADCAST_GLOBAL_RATE   = float(os.getenv("BROADCAST_GLOBAL_RATE", "25"))
+BROADCAST_CHAT_INTERVAL = float(os.getenv("BROADCAST_CHAT_INTERVAL", "3"))
+BROADCAST_WORKERS       = int(os.getenv("BROADCAST_WORKERS", "8"))
+BROADCAST_MAX_ATTEMPTS  = int(os.getenv("BROADCAST_MAX_ATTEMPTS", "4"))
+BROADCAST_PROGRESS_EVERY = int(os.getenv("BROADCAST_PROGRESS_EVERY", "250"))
+
+_broadcast_limiter = RateLimiter(BROADCAST_GLOBAL_RATE, 1 / BROADCAST_CHAT_INTERVAL)
+
+async def send_with_retry(bot, limiter: RateLimiter, chat_id: int, text: str,
+                          max_attempts: int = BROADCAST_MAX_ATTEMPTS) -> tuple[str, str | None]:
+    """Send one message, honouring RetryAfter and backing off on network errors.
+
+    Returns ("sent" | "skipped" | "failed", error text).
+    """
+    error = None
+    for attempt in range(1, max_attempts + 1):
+        await limiter.acquire(chat_id)
+        try:
+            await bot.send_message(chat_id=chat_id, text=text, disable_web_page_preview=True)
+            note_chat_ok(chat_id)
+            return "sent", None
+        except Forbidden as ex:
+            # bot removed/kicked or can’t send — skip, and count it against the chat
+            note_chat_failure(chat_id, ex)
+            return "skipped", str(ex)
+        except BadRequest as ex:
+            note_chat_failure(chat_id, ex)
+            return "failed", str(ex)
+        except RetryAfter as ex:
+            # flood control is bot-wide, so hold every worker, not just this one
+            limiter.pause(ex.retry_after + 0.5)
+            error = str(ex)
+        except NetworkError as ex:
+            error = str(ex)
+            await asyncio.sleep(min(30.0, 2 ** attempt) * (0.5 + random.random()))
+        except Exception as ex:
+            return "failed", str(ex)
+    return "failed", error
+
+# =========================
+# Broadcast outbox (Postgres)
+# =========================
+# Deliveries are claimed in batches with FOR UPDATE SKIP LOCKED, so a broadcast
+# resumes after a restart. Only one process sends at a time: every replica (and
+# sharded worker) runs broadcast_poller, but only the one holding BROADCAST_LOCK
+# starts broadcasts, so BROADCAST_GLOBAL_RATE is the bot's real broadcast rate.
+# In one process broadcasts also share TG_GLOBAL_RATE with everything else;
+# sharded workers reserve BROADCAST_GLOBAL_RATE for them (see _worker_loop).
+# When that process dies its lock goes with the connection, another one takes
+# over and re-claims whatever it left in 'sending' after BROADCAST_CLAIM_TIMEOUT.
+BROADCAST_BATCH         = int(os.getenv("BROADCAST_BATCH", "50"))
+BROADCAST_CLAIM_TIMEOUT = int(os.getenv("BROADCAST_CLAIM_TIMEOUT", "300"))  # seconds before a claim counts as abandoned
+BROADCAST_POLL_INTERVAL = float(os.getenv("BROADCAST_POLL_INTERVAL", "5"))
+BROADCAST_LOCK = 0x42636173  # pg_try_advisory_lock key of the broadcast sender
+_running_broadcasts: dict[int, asyncio.Task] = {}
+_broadcast_leader = False  # this process holds BROADCAST_LOCK
+
+@timed_query("create_broadcast")
+async def create_broadcast(text: str, report_chat_id: int | None,
+                           segment: str = "unpaid", days: int | None = None) -> tuple[int, int] | None:
+    """Queue `text` for every group in `segment`. Returns (broadcast_id, total) or None if there is nobody to send to."""
+    if segment == "active":
+        await _roll_writes.flush()
+    where, args = segment_filter(segment, days, arg=2)
+    async with db_acquire() as conn:
+        async with conn.transaction():
+            bid = await conn.fetchval(
+                "INSERT INTO broadcasts (text, report_chat_id, audience) VALUES ($1, $2, $3) RETURNING id",
+                text, report_chat_id, segment_label(segment, days),
+            )
+            # the segment is expanded inside Postgres, never loaded into the bot
+            res = await conn.execute(f"""
+                INSERT INTO broadcast_deliveries (broadcast_id, chat_id)
+                SELECT $1, c.chat_id FROM contacts c
+                WHERE {where}
+            """, bid, *args)
+            total = int(res.split()[-1])
+            if not total:
+                await conn.execute("DELETE FROM broadcasts WHERE id=$1", bid)
+                return None
+            await conn.execute("UPDATE broadcasts SET total=$2 WHERE id=$1", bid, total)
+            return bid, total
+
+@timed_query("claim_deliveries")
+async def claim_deliveries(broadcast_id: int, limit: int) -> list[int]:
+    async with db_acquire() as conn:
         rows = await conn.fetch("""
-            SELECT chat_id, COALESCE(group_title, CAST(chat_id AS TEXT)) AS title
-            FROM contacts
-            WHERE COALESCE(paid, FALSE) = FALSE
-        """)
-        return [(r["chat_id"], r["title"]) for r in rows]
+            UPDATE broadcast_deliveries d
+               SET status = 'sending', claimed_at = now(), attempts = d.attempts + 1
+              FROM (
+                SELECT broadcast_id, chat_id FROM broadcast_deliveries
+                 WHERE broadcast_id = $1
+                   AND (status = 'pending'
+                        OR (status = 'sending' AND claimed_at < now() - make_interval(secs => $3)))
+                 ORDER BY chat_id
+                 LIMIT $2
+                   FOR UPDATE SKIP LOCKED
+              ) c
+             WHERE d.broadcast_id = c.broadcast_id AND d.chat_id = c.chat_id
+            RETURNING d.chat_id
+        """, broadcast_id, limit, float(BROADCAST_CLAIM_TIMEOUT))
+        return [r["chat_id"] for r in rows]
+
+@timed_query("record_deliveries")
+async def record_deliveries(broadcast_id: int, results: list[tuple[int, str, str | None]]):
+    if not results:
+        return
+    async with db_acquire() as conn:
+        await conn.executemany("""
+            UPDATE broadcast_deliveries SET status=$3, error=$4
+            WHERE broadcast_id=$1 AND chat_id=$2 AND status='sending'
+        """, [(broadcast_id, chat_id, status, error) for chat_id, status, error in results])
+
+@timed_query("release_deliveries")
+async def release_deliveries(broadcast_id: int, chat_ids: list[int]):
+    """Hand claimed-but-unsent deliveries back to the pool (e.g. on shutdown)."""
+    if not chat_ids:
+        return
+    async with db_acquire() as conn:
+        await conn.execute("""
+            UPDATE broadcast_deliveries SET status='pending', claimed_at=NULL
+            WHERE broadcast_id=$1 AND chat_id = ANY($2::bigint[]) AND status='sending'
+        """, broadcast_id, chat_ids)
+
+@timed_query("get_broadcast")
+async def get_broadcast(broadcast_id: int | None = None):
+    """Broadcast row plus delivery counts by status; latest broadcast when no id is given."""
+    async with db_acquire() as conn:
+        if broadcast_id is None:
+            row = await conn.fetchrow("SELECT * FROM broadcasts ORDER BY id DESC LIMIT 1")
+        else:
+            row = await conn.fetchrow("SELECT * FROM broadcasts WHERE id=$1", broadcast_id)
+        if not row:
+            return None, {}
+        counts = await conn.fetch("""
+            SELECT status, count(*) AS n FROM broadcast_deliveries
+            WHERE broadcast_id=$1 GROUP BY status
+        """, row["id"])
+        return row, {r["status"]: r["n"] for r in counts}
+
+@timed_query("cancel_broadcast")
+async def cancel_broadcast(broadcast_id: int) -> int | None:
+    """Stop a running broadcast. Returns how many deliveries were dropped, or None if it wasn't running."""
+    async with db_acquire() as conn:
+        async with conn.transaction():
+            bid = await conn.fetchval("""
+                UPDATE broadcasts SET status='cancelled', finished_at=now()
+                WHERE id=$1 AND status='running' RETURNING id
+            """, broadcast_id)
+            if bid is None:
+                return None
+            res = await conn.execute("""
+                UPDATE broadcast_deliveries SET status='cancelled'
+                WHERE broadcast_id=$1 AND status='pending'
+            """, broadcast_id)
+            return int(res.split()[-1])
+
+@timed_query("finish_broadcast")
+async def finish_broadcast(broadcast_id: int):
+    """Mark the broadcast done once nothing is pending; only one replica wins the row."""
+    async with db_acquire() as conn:
+        return await conn.fetchrow("""
+            UPDATE broadcasts SET status='done', finished_at=now()
+            WHERE id=$1 AND status='running'
+              AND NOT EXISTS (
+                SELECT 1 FROM broadcast_deliveries
+                WHERE broadcast_id=$1 AND status IN ('pending', 'sending')
+              )
+            RETURNING report_chat_id
+        """, broadcast_id)
+
+@timed_query("claim_progress_report")
+async def claim_progress_report(broadcast_id: int, done: int) -> bool:
+    async with db_acquire() as conn:
+        return await conn.fetchval("""
+            UPDATE broadcasts SET reported=$2
+            WHERE id=$1 AND reported + $3 <= $2 RETURNING TRUE
+        """, broadcast_id, done, BROADCAST_PROGRESS_EVERY) is not None
+
+def broadcast_summary(row, counts: dict[str, int]) -> str:
+    failed = counts.get("failed", 0)
+    text = (f"Broadcast #{row['id']} ({row['status']}): sent to {counts.get('sent', 0)} of {row['total']} {row['audience']} groups. "
+            f"Skipped: {counts.get('skipped', 0)}. Failures: {failed}")
+    pending = counts.get("pending", 0) + counts.get("sending", 0)
+    if pending:
+        text += f". Pending: {pending}"
+    if counts.get("cancelled"):
+        text += f". Cancelled: {counts['cancelled']}"
+    if failed:
+        # keep it short; details are in broadcast_deliveries.error
+        text += "\nSome groups failed (bot removed, topics-only, etc.)."
+    return text
+
+async def run_broadcast(bot, broadcast_id: int, limiter: RateLimiter = _broadcast_limiter,
+                        workers: int = BROADCAST_WORKERS, batch: int = BROADCAST_BATCH):
+    """Claim and send deliveries for one broadcast until none are left."""
+    background_sends.set(True)
+    broadcast_sends.set(True)
+    row, _ = await get_broadcast(broadcast_id)
+    if not row or row["status"] != "running":
+        return
+    sem = asyncio.Semaphore(workers)
+
+    while True:
+        chat_ids = await claim_deliveries(broadcast_id, batch)
+        if not chat_ids:
+            break
+        results: list[tuple[int, str, str | None]] = []
+
+        async def deliver(chat_id: int):
+            async with sem:
+                status, error = await send_with_retry(bot, limiter, chat_id, row["text"])
+            broadcast_results.inc(status=status)
+            if status == "failed":
+                log.warning("Broadcast %s to %s failed: %s", broadcast_id, chat_id, error)
+            results.append((chat_id, status, error))
+
+        try:
+            await asyncio.gather(*(deliver(c) for c in chat_ids))
+        except asyncio.CancelledError:
+            # shutting down: keep what we sent, give the rest back
+            finished = {r[0] for r in results}
+            await record_deliveries(broadcast_id, results)
+            await release_deliveries(broadcast_id, [c for c in chat_ids if c not in finished])
+            raise
+        await record_deliveries(broadcast_id, results)
+        await _report_broadcast_progress(bot, broadcast_id)
+
+    done = await finish_broadcast(broadcast_id)
+    if done and done["report_chat_id"]:
+        row, counts = await get_broadcast(broadcast_id)
+        await bot.send_message(done["report_chat_id"], broadcast_summary(row, counts))
+
+async def _report_broadcast_progress(bot, broadcast_id: int):
+    row, counts = await get_broadcast(broadcast_id)
+    if not row or not row["report_chat_id"]:
+        return
+    done = sum(n for status, n in counts.items() if status not in ("pending", "sending"))
+    if done >= row["total"] or not await claim_progress_report(broadcast_id, done):
+        return
+    try:
+        await bot.send_message(row["report_chat_id"], f"Broadcast #{broadcast_id}: {done}/{row['total']} processed…")
+    except Exception:
+        log.warning("Could not send broadcast progress to %s", row["report_chat_id"])
+
+def start_broadcast(bot, broadcast_id: int):
+    if not _broadcast_leader:
+        # the process holding BROADCAST_LOCK picks it up on its next poll
+        return None
+    task = _running_broadcasts.get(broadcast_id)
+    if task and not task.done():
+        return task
+    task = spawn(run_broadcast(bot, broadcast_id), name=f"broadcast:{broadcast_id}")
+    _running_broadcasts[broadcast_id] = task
+    task.add_done_callback(lambda t: _running_broadcasts.pop(broadcast_id, None))
+    return task
+
+async def broadcast_poller(bot):
+    """Take BROADCAST_LOCK on a dedicated connection, then run every broadcast that is 'running'.
+
+    Covers broadcasts interrupted by a restart and ones /sendad created on another replica.
+    """
+    global _broadcast_leader
+    while True:
+        conn = None
+        try:
+            conn = await asyncpg.connect(DB_URL)
+            while not await conn.fetchval("SELECT pg_try_advisory_lock($1)", BROADCAST_LOCK, timeout=10):
+                await asyncio.sleep(BROADCAST_POLL_INTERVAL)
+            _broadcast_leader = True
+            log.info("This process now sends broadcasts")
+            while True:
+                # doubles as the heartbeat of the connection that holds the lock
+                rows = await conn.fetch("SELECT id FROM broadcasts WHERE status='running'", timeout=10)
+                for r in rows:
+                    start_broadcast(bot, r["id"])
+                await asyncio.sleep(BROADCAST_POLL_INTERVAL)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.warning("broadcast poller lost its connection, reconnecting", exc_info=True)
+        finally:
+            if _broadcast_leader:
+                # the lock is gone with the connection; another process may be sending already
+                _broadcast_leader = False
+                for task in list(_running_broadcasts.values()):
+                    task.cancel()
+            if conn is not None and not conn.is_closed():
+                conn.terminate()
+        await asyncio.sleep(5)
+
+# =========================
+# Roll statistics
+# =========================
+# Rolls are counted in memory per (chat, user, day) and flushed in bulk into
+# roll_stats (daily buckets) and roll_totals (all-time rollup per user), so
+# /stats and /leaderboard never scan individual rolls.
+JACKPOT_VALUE  = 64
+TRIPLE_VALUES  = {1, 22, 43}  # three bars / grapes / lemons
+STATS_FLUSH_INTERVAL = float(os.getenv("STATS_FLUSH_INTERVAL", "30"))
+STATS_FLUSH_MAX      = int(os.getenv("STATS_FLUSH_MAX", "2000"))
+LEADERBOARD_SIZE     = int(os.getenv("LEADERBOARD_SIZE", "10"))
+MAX_DAYS             = 3650  # longest "last N days" window; further back than date() can go
+
+def days_arg(raw: str, maximum: int = MAX_DAYS) -> int | None:
+    """Positive day count from a command argument, capped at `maximum`; None if it isn't one."""
+    if not raw.isdecimal():
+        return None
+    # don't int() a huge digit string just to cap it
+    days = int(raw) if len(raw) <= len(str(maximum)) else maximum
+    return min(days, maximum) if days > 0 else None
+
+def _merge_roll_counts(old: tuple, new: tuple) -> tuple:
+    # (rolls, jackpots, triples, display name) — keep the newest name
+    return old[0] + new[0], old[1] + new[1], old[2] + new[2], new[3] or old[3]
+
+@timed_query("store_roll_counts")
+async def store_roll_counts(batch: dict[tuple[int, int, date], tuple]):
+    days = [(chat_id, user_id, day, *counts[:3]) for (chat_id, user_id, day), counts in batch.items()]
+    totals: dict[tuple[int, int], tuple] = {}
+    for (chat_id, user_id, _), counts in batch.items():
+        key = (chat_id, user_id)
+        totals[key] = _merge_roll_counts(totals[key], counts) if key in totals else counts
+
+    async with db_acquire() as conn:
+        async with conn.transaction():
+            await conn.execute("""
+                INSERT INTO roll_stats (chat_id, user_id, day, rolls, jackpots, triples)
+                SELECT * FROM UNNEST($1::bigint[], $2::bigint[], $3::date[], $4::int[], $5::int[], $6::int[])
+                ON CONFLICT (chat_id, user_id, day) DO UPDATE SET
+                  rolls    = roll_stats.rolls    + EXCLUDED.rolls,
+                  jackpots = roll_stats.jackpots + EXCLUDED.jackpots,
+                  triples  = roll_stats.triples  + EXCLUDED.triples
+            """, *map(list, zip(*days)))
+            await conn.execute("""
+                INSERT INTO roll_totals (chat_id, user_id, rolls, jackpots, triples, username)
+                SELECT * FROM UNNEST($1::bigint[], $2::bigint[], $3::bigint[], $4::bigint[], $5::bigint[], $6::text[])
+                ON CONFLICT (chat_id, user_id) DO UPDATE SET
+                  rolls    = roll_totals.rolls    + EXCLUDED.rolls,
+                  jackpots = roll_totals.jackpots + EXCLUDED.jackpots,
+                  triples  = roll_totals.triples  + EXCLUDED.triples,
+                  username = COALESCE(EXCLUDED.username, roll_totals.username)
+            """, *map(list, zip(*[(c, u, *counts) for (c, u), counts in totals.items()])))
+
+_roll_writes = WriteBehind("roll-stats", store_roll_counts, merge=_merge_roll_counts,
+                           max_pending=STATS_FLUSH_MAX, interval=STATS_FLUSH_INTERVAL)
+
+def count_roll(chat_id: int, user, value: int):
+    """Record one 🎰 roll in memory; _roll_writes flushes it later."""
+    name = f"@{user.username}" if user.username else user.full_name
+    day = datetime.now(timezone.utc).date()
+    _roll_writes.put((chat_id, user.id, day),
+                     (1, int(value == JACKPOT_VALUE), int(value in TRIPLE_VALUES), name))
+
+def pending_rolls(chat_id: int, since: date | None = None) -> dict[int, tuple]:
+    """user_id -> (rolls, jackpots, triples, name) of `chat_id` not flushed to Postgres yet."""
+    pending: dict[int, tuple] = {}
+    for (c, user_id, day), counts in _roll_writes.items():
+        if c != chat_id or (since and day < since):
+            continue
+        pending[user_id] = _merge_roll_counts(pending[user_id], counts) if user_id in pending else counts
+    return pending
+
+def _add_pending(row, counts: tuple | None) -> dict:
+    row = dict(row)
+    if counts:
+        row["rolls"] += counts[0]
+        row["jackpots"] += counts[1]
+        row["triples"] += counts[2]
+        if "username" in row:
+            row["username"] = counts[3] or row["username"]
+    return row
+
+def _top_players(rows, pending: dict[int, tuple], limit: int) -> list[dict]:
+    board = {r["user_id"]: _add_pending(r, pending.get(r["user_id"])) for r in rows}
+    for user_id, counts in pending.items():
+        if user_id not in board:
+            board[user_id] = {"user_id": user_id, "username": counts[3],
+                              "rolls": counts[0], "jackpots": counts[1], "triples": counts[2]}
+    return sorted(board.values(), key=lambda r: (r["jackpots"], r["rolls"]), reverse=True)[:limit]
+
+# Read paths never flush _roll_writes: they answer from the rollups plus this
+# chat's counts still in memory, so /stats spam can't stall the update loop.
+@timed_query("get_chat_stats")
+async def get_chat_stats(chat_id: int, user_id: int | None = None):
+    """(group totals, this user's totals) from the roll_totals rollup and the unflushed rolls."""
+    pending = pending_rolls(chat_id)
+    async with db_acquire() as conn:
+        group = await conn.fetchrow("""
+            SELECT count(*) AS players, count(*) FILTER (WHERE user_id = ANY($2)) AS known,
+                   COALESCE(sum(rolls), 0) AS rolls,
+                   COALESCE(sum(jackpots), 0) AS jackpots, COALESCE(sum(triples), 0) AS triples
+            FROM roll_totals WHERE chat_id=$1
+        """, chat_id, list(pending))
+        mine = None
+        if user_id is not None:
+            mine = await conn.fetchrow(
+                "SELECT rolls, jackpots, triples FROM roll_totals WHERE chat_id=$1 AND user_id=$2",
+                chat_id, user_id,
+            )
+    group = dict(group)
+    group["players"] += len(pending) - group.pop("known")
+    for counts in pending.values():
+        group = _add_pending(group, counts)
+    if user_id in pending:
+        mine = _add_pending(mine or {"rolls": 0, "jackpots": 0, "triples": 0}, pending[user_id])
+    return group, mine
+
+@timed_query("get_leaderboard")
+async def get_leaderboard(chat_id: int, days: int | None = None, limit: int = LEADERBOARD_SIZE):
+    """Top players by jackpots (then rolls): all-time from roll_totals, or the last `days` days from roll_stats.
+
+    The rollup's top `limit` plus the rollup rows of users with unflushed rolls is
+    enough to rank exactly: only those users' counts can have grown.
+    """
+    since = datetime.now(timezone.utc).date() - timedelta(days=days - 1) if days else None
+    pending = pending_rolls(chat_id, since)
+    async with db_acquire() as conn:
+        if not days:
+            rows = await conn.fetch("""
+                (SELECT user_id, username, rolls, jackpots, triples FROM roll_totals
+                 WHERE chat_id=$1
+                 ORDER BY jackpots DESC, rolls DESC
+                 LIMIT $2)
+                UNION
+                SELECT user_id, username, rolls, jackpots, triples FROM roll_totals
+                WHERE chat_id=$1 AND user_id = ANY($3)
+            """, chat_id, limit, list(pending))
+        else:
+            rows = await conn.fetch("""
+                WITH s AS (
+                  SELECT user_id, sum(rolls) AS rolls, sum(jackpots) AS jackpots, sum(triples) AS triples
+                  FROM roll_stats WHERE chat_id=$1 AND day >= $2
+                  GROUP BY user_id
+                )
+                SELECT s.user_id, t.username, s.rolls, s.jackpots, s.triples
+                FROM (
+                  (SELECT * FROM s ORDER BY jackpots DESC, rolls DESC LIMIT $3)
+                  UNION
+                  SELECT * FROM s WHERE user_id = ANY($4)
+                ) s
+                LEFT JOIN roll_totals t ON t.chat_id=$1 AND t.user_id=s.user_id
+            """, chat_id, since, limit, list(pending))
+    return _top_players(rows, pending, limit)
+
+# =========================
+# Templates / i18n
+# =========================
+# Reply strings live here, per locale, compiled once at import. A locale only
+# lists what it translates; everything else falls back to FALLBACK_LOCALE.
+BOT_LOCALE      = os.getenv("BOT_LOCALE", "he")
+FALLBACK_LOCALE = "en"
+
+TEMPLATES = {
+    "en": {
+        "start": "Copy an emoji and send it *alone* to roll:",
+        "jackpot": "User: {user} Just Hit the JACKPOT!{contact_line}",
+        "jackpot_contact": "\n\nPlease contact @{username} to claim your prize!",
+        "jackpot_contact_link": '\nPlease contact <a href="tg://user?id={user_id}">{name}</a>',
+        "jackpot_dm": "The user @{user} just won 777! They will message you!",
+        "contact_button": "Message @{username}",
+        "current_contact": "Current contact: @{username}",
+        "current_contact_link": 'Current contact: <a href="tg://user?id={user_id}">{name}</a>',
+        "no_contact": "No contact set for this group.",
+        "help": """\
+Available commands:
+/start – Check that the bot is alive
+/help – Show this help
+
+# Group admin commands
+/setcontact @username – Set the public contact user for this group
+  • Tip: reply to a user's message with /setcontact to set that person (captures their ID)
+/getcontact – Show the current contact for this group
+/unsetcontact – Clear the contact (username stays empty)
+
+/setnotify <user_id> – Set the notifier user ID (bot will DM them on JACKPOT)
+/unsetnotify – Clear the notifier user ID (keeps the /setcontact username)
+/addnotify <user_id> – DM another user on JACKPOT too
+/removenotify <user_id> – Stop DMing an extra notifier
+
+# Stats
+/stats – Rolls, jackpots and three-in-a-row counts for this group (and you)
+/leaderboard [days] – Top players by jackpots, all-time or for the last N days
+
+Notes:
+• To receive DMs from the bot, the notifier must /start the bot at least once.
+• If you're an anonymous admin (“send as group”), the bot still recognizes you as admin.""",
+    },
+    "he": {
+        "start": "תעתיק ותדביק את האימוגי הזה לבד על מנת לשחק!",
+        "jackpot": "המשתמש {user} הוציא 777! כל הכבוד! {contact_line}",
+        "jackpot_contact": "\n\nנא לשלוח הודעה ל{username} על מנת לקבל את הפרס!",
+    },
+}
+
+# locale -> key -> bound str.format
+_compiled = {
+    loc: {key: text.format for key, text in {**TEMPLATES[FALLBACK_LOCALE], **msgs}.items()}
+    for loc, msgs in TEMPLATES.items()
+}
+
+def tr(key: str, locale: str | None = None, **kw) -> str:
+    """Render template `key` for `locale` (default BOT_LOCALE)."""
+    return _compiled.get(locale or BOT_LOCALE, _compiled[FALLBACK_LOCALE])[key](**kw)
+
+@functools.lru_cache(maxsize=CONTACT_CACHE_SIZE)
+def contact_keyboard(username: str, locale: str | None = None) -> InlineKeyboardMarkup:
+    # markups are immutable, so one instance per contact is shared by every reply
+    return InlineKeyboardMarkup(
+        [[InlineKeyboardButton(tr("contact_button", locale, username=username), url=f"https://t.me/{username}")]]
+    )
+
+@functools.lru_cache(maxsize=CONTACT_CACHE_SIZE)
+def jackpot_contact(username: str | None, user_id: int | None, name: str | None,
+                    locale: str | None = None) -> tuple[str, InlineKeyboardMarkup | None, str | None]:
+    """(contact_line, reply_markup, parse_mode) for a jackpot announcement."""
+    if username:
+        return tr("jackpot_contact", locale, username=username), contact_keyboard(username, locale), None
+    if user_id:
+        link = tr("jackpot_contact_link", locale, user_id=user_id, name=html.escape(name or "this user"))
+        return link, None, ParseMode.HTML
+    return "", None, None
+
+@functools.lru_cache(maxsize=None)
+def help_text(locale: str | None = None) -> str:
+    return tr("help", locale)
+
+# (command, description) as shown in Telegram's command menu
+BOT_COMMANDS = (
+    ("start", "Check bot status"),
+    ("help", "Show help"),
+    ("setcontact", "Set group contact (@username or via reply)"),
+    ("getcontact", "Show group contact"),
+    ("unsetcontact", "Clear group contact"),
+    ("setnotify", "Set notifier user_id (DM on JACKPOT)"),
+    ("unsetnotify", "Clear notifier user_id"),
+    ("addnotify", "Add another jackpot notifier"),
+    ("removenotify", "Remove an extra jackpot notifier"),
+    ("stats", "Roll stats for this group"),
+    ("leaderboard", "Top players in this group"),
+)
+
+async def sync_bot_commands(bot: Bot):
+    """set_my_commands only when BOT_COMMANDS changed since the last successful call."""
+    digest = hashlib.sha256(json.dumps(BOT_COMMANDS).encode()).hexdigest()
+    key = f"commands_hash:{bot.id}"
+    async with db_acquire() as conn:
+        if await conn.fetchval("SELECT value FROM bot_settings WHERE key=$1", key) == digest:
+            return
+    await bot.set_my_commands([BotCommand(cmd, desc) for cmd, desc in BOT_COMMANDS])
+    async with db_acquire() as conn:
+        await conn.execute("""
+            INSERT INTO bot_settings (key, value) VALUES ($1, $2)
+            ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
+        """, key, digest)
+    log.info("Bot commands updated")
 
 # =========================
 # Commands
 # =========================
+@timed_handler("setcontact")
 async def set_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Auto-cache group title
     if update.effective_chat and update.effective_chat.type in ("group", "supergroup"):
-        await refresh_group_title(context, update.effective_chat.id)
+        await refresh_group_title(context, update.effective_chat.id, update.effective_chat.title)
 
     if not await is_admin(update, context):
         return await update.message.reply_text("Only group admins can set the contact.")
@@ -135,14 +1927,19 @@ async def set_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
     who = f"@{username}" if username else (name or "this user")
     await update.message.reply_text(f"Contact set to {who} for this group ✅")
 
+@timed_query("set_paid_status")
 async def set_paid_status(chat_id: int, paid: bool):
-    async with _pool.acquire() as conn:
-        await conn.execute("""
+    async with db_acquire() as conn:
+        row = await conn.fetchrow("""
           INSERT INTO contacts (chat_id, paid)
           VALUES ($1, $2)
           ON CONFLICT (chat_id) DO UPDATE SET paid = EXCLUDED.paid
+          RETURNING username, user_id, name, paid
         """, chat_id, paid)
+    invalidate_contact(chat_id)
+    _contact_cache.set(chat_id, _contact_record(row))
 
+@timed_handler("sendad")
 async def sendad(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # OWNER ONLY
     if not is_owner(update):
@@ -159,62 +1956,145 @@ async def sendad(update: Update, context: ContextTypes.DEFAULT_TYPE):
             quote=False
         )
 
-    groups = await list_unpaid_groups()
-    if not groups:
-        return await update.message.reply_text("No unpaid groups found.", quote=False)
+    await _start_ad(update, context, ad_text, "unpaid")
 
-    sent = 0
-    skipped = 0
-    failures = []
+async def _start_ad(update: Update, context: ContextTypes.DEFAULT_TYPE, ad_text: str,
+                    segment: str, days: int | None = None):
+    label = segment_label(segment, days)
+    created = await create_broadcast(ad_text, update.effective_chat.id, segment, days)
+    if not created:
+        return await update.message.reply_text(f"No {label} groups found.", quote=False)
 
-    for chat_id, title in groups:
-        try:
-            await context.bot.send_message(chat_id=chat_id, text=ad_text, disable_web_page_preview=True)
-            sent += 1
-            # small delay to be nice to rate limits
-            await asyncio.sleep(0.05)
-        except RetryAfter as e:
-            # back off exactly as Telegram requests, then retry once
-            await asyncio.sleep(e.retry_after + 0.5)
-            try:
-                await context.bot.send_message(chat_id=chat_id, text=ad_text, disable_web_page_preview=True)
-                sent += 1
-            except Exception as ex:
-                failures.append((chat_id, str(ex)))
-        except Forbidden as ex:
-            # bot removed/kicked or can’t send — skip
-            skipped += 1
-        except BadRequest as ex:
-            failures.append((chat_id, str(ex)))
-        except Exception as ex:
-            failures.append((chat_id, str(ex)))
+    bid, total = created
+    start_broadcast(context.bot, bid)
+    await update.message.reply_text(
+        f"Broadcast #{bid} started to {total} {label} groups. I'll report back when it's done.\n"
+        f"Use /adstatus {bid} to check progress or /adcancel {bid} to stop it.",
+        quote=False
+    )
 
-    # Summary back to you
-    summary = f"Sent to {sent} unpaid groups. Skipped: {skipped}. Failures: {len(failures)}"
-    if failures:
-        # keep it short; you can log details server-side if you prefer
-        summary += "\nSome groups failed (bot removed, topics-only, etc.)."
-    await update.message.reply_text(summary, quote=False)
+def _segment_args(args: list[str]) -> tuple[str | None, int | None, list[str]]:
+    """Parse "<segment> [days] ..." -> (segment, days, rest)."""
+    if not args or args[0].lower() not in SEGMENTS:
+        return None, None, args
+    segment, rest = args[0].lower(), args[1:]
+    days = None
+    if segment == "active" and rest and rest[0].isdecimal():
+        days, rest = days_arg(rest[0]) or 1, rest[1:]
+    return segment, days, rest
+
+@timed_handler("sendto")
+async def sendto(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # OWNER ONLY
+    if not is_owner(update):
+        return await update.message.reply_text("Only the bot owner can send ads.", quote=False)
 
-async def get_paid_status(chat_id: int) -> bool:
-    async with _pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT paid FROM contacts WHERE chat_id=$1", chat_id)
-        return bool(row["paid"]) if row else False
+    segment, days, rest = _segment_args(context.args or [])
+    ad_text = " ".join(rest).strip()
+    if not ad_text and update.message.reply_to_message and update.message.reply_to_message.text:
+        ad_text = update.message.reply_to_message.text.strip()
 
-async def refresh_group_title(context, chat_id: int) -> str | None:
-    """Fetch current title from Telegram (only works if the bot is in the group) and cache it."""
-    try:
-        chat = await context.bot.get_chat(chat_id)
+    if not segment or not ad_text:
+        return await update.message.reply_text(
+            f"Usage: /sendto <{'|'.join(SEGMENTS)}> [days] <text>\n"
+            "Or reply to a message with /sendto <segment> [days].",
+            quote=False
+        )
+    await _start_ad(update, context, ad_text, segment, days)
+
+@timed_handler("segment")
+async def segment_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # OWNER ONLY
+    if not is_owner(update):
+        return await update.message.reply_text("Only the bot owner can inspect segments.", quote=False)
+
+    segment, days, _ = _segment_args(context.args or [])
+    if not segment:
+        return await update.message.reply_text(f"Usage: /segment <{'|'.join(SEGMENTS)}> [days]", quote=False)
+    total = await count_segment(segment, days)
+    await update.message.reply_text(f"{total} {segment_label(segment, days)} groups.", quote=False)
+
+def _broadcast_id_arg(context) -> int | None:
+    raw = context.args[0].lstrip("#") if context.args else ""
+    return int(raw) if raw.isdigit() else None
+
+@timed_handler("adstatus")
+async def adstatus(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # OWNER ONLY
+    if not is_owner(update):
+        return await update.message.reply_text("Only the bot owner can check ads.", quote=False)
+
+    row, counts = await get_broadcast(_broadcast_id_arg(context))
+    if not row:
+        return await update.message.reply_text("No broadcasts yet.", quote=False)
+    await update.message.reply_text(broadcast_summary(row, counts), quote=False)
+
+@timed_handler("adcancel")
+async def adcancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # OWNER ONLY
+    if not is_owner(update):
+        return await update.message.reply_text("Only the bot owner can cancel ads.", quote=False)
+
+    bid = _broadcast_id_arg(context)
+    if bid is None:
+        row, _ = await get_broadcast()
+        if not row:
+            return await update.message.reply_text("No broadcasts yet.", quote=False)
+        bid = row["id"]
+    dropped = await cancel_broadcast(bid)
+    if dropped is None:
+        return await update.message.reply_text(f"Broadcast #{bid} is not running.", quote=False)
+    await update.message.reply_text(f"Broadcast #{bid} cancelled. {dropped} pending deliveries dropped.", quote=False)
+
+async def get_paid_status(chat_id: int) -> bool:
+    return (await load_contact(chat_id)).paid
+
+async def refresh_group_title(context, chat_id: int, title: str | None = None) -> str | None:
+    """Return the group title, caching it in-process and in Postgres.
+
+    Pass `title` when the update already carries it (every group message does);
+    otherwise we only call get_chat when the cache entry is missing or expired.
+    Postgres is written only when the title actually changed.
+    """
+    cached = _title_cache.get(chat_id)
+    if title is None:
+        if cached is not None:
+            return cached
+        try:
+            chat = await context.bot.get_chat(chat_id)
+        except Exception:
+            return None
         title = chat.title
-        async with _pool.acquire() as conn:
-            await conn.execute("""
-              INSERT INTO contacts (chat_id, group_title)
-              VALUES ($1, $2)
-              ON CONFLICT (chat_id) DO UPDATE SET group_title = EXCLUDED.group_title
-            """, chat_id, title)
-        return title
-    except Exception:
+    if title is None:
         return None
+    if title != cached:
+        # queued; flushed in bulk by _title_writes
+        _title_writes.put(chat_id, title)
+    _title_cache.set(chat_id, title)
+    return title
+
+@timed_query("store_group_titles")
+async def store_group_titles(titles: dict[int, str]):
+    """Bulk UPSERT of {chat_id: title}; rows that already hold the title are left alone."""
+    chat_ids = list(titles)
+    async with db_acquire() as conn:
+        await conn.stmts["titles"].fetch(chat_ids, [titles[c] for c in chat_ids])
+    for chat_id in chat_ids:
+        if _contact_cache.get(chat_id) is _NO_CONTACT:
+            # the UPSERT may have just created the row
+            invalidate_contact(chat_id)
+
+WRITE_BEHIND_MAX      = int(os.getenv("WRITE_BEHIND_MAX", "500"))
+WRITE_BEHIND_INTERVAL = float(os.getenv("WRITE_BEHIND_INTERVAL", "2"))
+_title_writes = WriteBehind("group-titles", store_group_titles,
+                            max_pending=WRITE_BEHIND_MAX, interval=WRITE_BEHIND_INTERVAL)
+
+@timed_handler("new_chat_title")
+async def on_new_chat_title(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Service message: someone renamed the group
+    msg = update.effective_message
+    if msg and msg.new_chat_title:
+        await refresh_group_title(context, update.effective_chat.id, msg.new_chat_title)
 
 def is_owner(update: Update) -> bool:
     u = update.effective_user
@@ -225,6 +2105,7 @@ def is_owner(update: Update) -> bool:
     return bool(u.username and u.username.lower() == OWNER_USERNAME.lower().lstrip("@"))
 
 
+@timed_handler("setpaid")
 async def setpaid(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # must run inside the target group (keep your logic)
     if update.effective_chat.type not in ("group", "supergroup"):
@@ -244,49 +2125,88 @@ async def setpaid(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return await update.message.reply_text("Usage: /setpaid on|off", quote=False)
 
     await set_paid_status(update.effective_chat.id, paid)
-    title = await refresh_group_title(context, update.effective_chat.id)
+    title = await refresh_group_title(context, update.effective_chat.id, update.effective_chat.title)
     await update.message.reply_text(
         f"Paid set to *{paid}* for {title or 'this group'}.",
         parse_mode="Markdown", quote=False
     )
 
+@timed_handler("getpaid")
 async def getpaid(update: Update, context: ContextTypes.DEFAULT_TYPE):
     paid = await get_paid_status(update.effective_chat.id)
     await update.message.reply_text(f"Paid: *{paid}*", parse_mode="Markdown", quote=False)
 
+@timed_handler("stats")
+async def stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_chat.type not in ("group", "supergroup"):
+        return await update.message.reply_text("Use /stats inside a group.", quote=False)
+
+    user = update.effective_user
+    group, mine = await get_chat_stats(update.effective_chat.id, user.id if user else None)
+    text = (f"🎰 Group stats\n"
+            f"Players: {group['players']}\n"
+            f"Rolls: {group['rolls']}\n"
+            f"Jackpots (777): {group['jackpots']}\n"
+            f"Three in a row: {group['triples']}")
+    if mine:
+        text += f"\n\nYou: {mine['rolls']} rolls, {mine['jackpots']} jackpots, {mine['triples']} three in a row"
+    await update.message.reply_text(text, quote=False)
+
+@timed_handler("leaderboard")
+async def leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_chat.type not in ("group", "supergroup"):
+        return await update.message.reply_text("Use /leaderboard inside a group.", quote=False)
+
+    # /leaderboard [days]
+    raw = context.args[0] if context.args else ""
+    days = days_arg(raw)
+    rows = await get_leaderboard(update.effective_chat.id, days)
+    if not rows:
+        return await update.message.reply_text("No rolls yet. Send 🎰 to play!", quote=False)
+
+    title = f"🏆 Leaderboard (last {days} days)" if days else "🏆 Leaderboard"
+    lines = [title]
+    for i, r in enumerate(rows, 1):
+        who = r["username"] or str(r["user_id"])
+        lines.append(f"{i}. {who} — {r['jackpots']} jackpots, {r['triples']} three in a row, {r['rolls']} rolls")
+    await update.message.reply_text("\n".join(lines), quote=False)
+
+@timed_handler("getcontact")
 async def get_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Auto-cache group title
     if update.effective_chat and update.effective_chat.type in ("group", "supergroup"):
-        await refresh_group_title(context, update.effective_chat.id)
+        await refresh_group_title(context, update.effective_chat.id, update.effective_chat.title)
 
     chat_id = update.effective_chat.id
     row = await get_contact_db(chat_id)
     if not row:
-        return await update.message.reply_text("No contact set for this group.")
+        return await update.message.reply_text(tr("no_contact"))
     username, uid, name = row
     if username:
-        kb = InlineKeyboardMarkup([[InlineKeyboardButton(f"Message @{username}", url=f"https://t.me/{username}")]])
-        return await update.message.reply_text(f"Current contact: @{username}", reply_markup=kb)
-    link = f'<a href="tg://user?id={uid}">{name or "this user"}</a>'
-    return await update.message.reply_text(f"Current contact: {link}", parse_mode=ParseMode.HTML, disable_web_page_preview=True)
+        return await update.message.reply_text(tr("current_contact", username=username),
+                                               reply_markup=contact_keyboard(username))
+    text = tr("current_contact_link", user_id=uid, name=html.escape(name or "this user"))
+    return await update.message.reply_text(text, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
 
+@timed_handler("unsetcontact")
 async def unset_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Auto-cache group title
     if update.effective_chat and update.effective_chat.type in ("group", "supergroup"):
-        await refresh_group_title(context, update.effective_chat.id)
+        await refresh_group_title(context, update.effective_chat.id, update.effective_chat.title)
 
     if not await is_admin(update, context):
         return await update.message.reply_text("Only group admins can unset the contact.")
     await unset_contact_db(update.effective_chat.id)
     await update.message.reply_text("Contact cleared for this group.")
 
+@timed_handler("setnotify")
 async def setnotify(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Auto-cache group title
     if update.effective_chat and update.effective_chat.type in ("group", "supergroup"):
-        await refresh_group_title(context, update.effective_chat.id)
+        await refresh_group_title(context, update.effective_chat.id, update.effective_chat.title)
 
     # must be used *in the target group*
     if update.effective_chat.type not in ("group", "supergroup"):
@@ -323,11 +2243,12 @@ async def setnotify(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await update.message.reply_text(f"Notifier set to user_id={uid}. {status}")
 
+@timed_handler("unsetnotify")
 async def unsetnotify(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Auto-cache group title
     if update.effective_chat and update.effective_chat.type in ("group", "supergroup"):
-        await refresh_group_title(context, update.effective_chat.id)
+        await refresh_group_title(context, update.effective_chat.id, update.effective_chat.title)
 
     # must be used inside the target group
     if update.effective_chat.type not in ("group", "supergroup"):
@@ -350,39 +2271,63 @@ async def unsetnotify(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await set_contact_db(chat_id, username=username, user_id=None, name=None)
     await update.message.reply_text("Notifier (user_id) cleared. The contact @username remains unchanged.")
 
+async def _notifier_arg(update: Update, context: ContextTypes.DEFAULT_TYPE, cmd: str) -> int | None:
+    """Shared checks for /addnotify and /removenotify; replies and returns None on bad input."""
+    if update.effective_chat.type not in ("group", "supergroup"):
+        await update.message.reply_text(f"Use /{cmd} inside the group you want to configure.")
+        return None
+    if not await is_admin(update, context):
+        await update.message.reply_text("Only group admins can change notifiers.")
+        return None
+    raw = context.args[0].strip() if context.args else ""
+    if not raw.isdigit():
+        await update.message.reply_text(f"Usage: /{cmd} <user_id>")
+        return None
+    return int(raw)
+
+@timed_handler("addnotify")
+async def addnotify(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = await _notifier_arg(update, context, "addnotify")
+    if uid is None:
+        return
+    await add_notifier(update.effective_chat.id, uid)
+    await update.message.reply_text(f"Added notifier user_id={uid}. They must /start the bot once to get DMs.")
+
+@timed_handler("removenotify")
+async def removenotify(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = await _notifier_arg(update, context, "removenotify")
+    if uid is None:
+        return
+    if await remove_notifier(update.effective_chat.id, uid):
+        return await update.message.reply_text(f"Removed notifier user_id={uid}.")
+    await update.message.reply_text(f"user_id={uid} is not an extra notifier here (use /unsetnotify for the main one).")
+
+@timed_handler("start")
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # short instructions
     #await update.message.reply_text "Copy an emoji and send it *alone* to roll:\n"
-    await update.message.reply_text("תעתיק ותדביק את האימוגי הזה לבד על מנת לשחק!")
+    await update.message.reply_text(tr("start"))
     # extra: send standalone messages for easy copy
     await update.message.reply_text("🎰", quote=False)
     #await update.message.reply_text("🎲", quote=False)
 
+@timed_handler("help")
 async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    HELP_TEXT = dedent("""
-    Available commands:
-/start – Check that the bot is alive
-/help – Show this help
-
-# Group admin commands
-/setcontact @username – Set the public contact user for this group
-  • Tip: reply to a user's message with /setcontact to set that person (captures their ID)
-/getcontact – Show the current contact for this group
-/unsetcontact – Clear the contact (username stays empty)
-
-/setnotify <user_id> – Set the notifier user ID (bot will DM them on JACKPOT)
-/unsetnotify – Clear the notifier user ID (keeps the /setcontact username)
-
-Notes:
-• To receive DMs from the bot, the notifier must /start the bot at least once.
-• If you're an anonymous admin (“send as group”), the bot still recognizes you as admin.
-    """).strip()
-
-    await update.message.reply_text(HELP_TEXT, quote=False)
+    await update.message.reply_text(help_text(), quote=False)
 
 async def on_error(update, context: ContextTypes.DEFAULT_TYPE):
-    # Log the stack trace
-    log.exception("Error while handling update: %s", context.error)
+    handler_errors.inc()
+    if isinstance(context.error, RetryAfter):
+        # flood limit for this chat (ours or Telegram's): replying would only hit it again
+        log.info("Reply dropped by flood control: %s", context.error)
+        return
+    busy = isinstance(context.error, DatabaseBusy)
+    if busy:
+        # Postgres is slow/saturated: no stack trace, just tell the user to retry
+        log.warning("Database busy while handling update: %s", context.error)
+    else:
+        # Log the stack trace
+        log.exception("Error while handling update: %s", context.error)
     # Optional: tell the chat something went wrong (don’t crash if that fails)
     try:
         chat = update.effective_chat if isinstance(update, Update) else None
@@ -391,20 +2336,407 @@ async def on_error(update, context: ContextTypes.DEFAULT_TYPE):
             thread_id = getattr(getattr(update, "effective_message", None), "message_thread_id", None)
             await context.bot.send_message(
                 chat_id=chat.id,
-                text="⚠️ Oops, something went wrong. Please try again.",
+                text=("⏳ I'm a bit overloaded right now. Please try again in a moment." if busy
+                      else "⚠️ Oops, something went wrong. Please try again."),
                 message_thread_id=thread_id,
             )
     except Exception:
         pass
 
+# =========================
+# Background tasks
+# =========================
+# Seconds to wait before announcing a jackpot, so the 🎰 animation finishes first
+DICE_REVEAL_DELAY = float(os.getenv("DICE_REVEAL_DELAY", "1.5"))
+_background_tasks: set[asyncio.Task] = set()
+
+def spawn(coro, name: str | None = None) -> asyncio.Task:
+    """Run `coro` in the background without holding the update pipeline."""
+    task = asyncio.create_task(coro, name=name)
+    _background_tasks.add(task)
+    task.add_done_callback(_on_background_done)
+    return task
+
+def _on_background_done(task: asyncio.Task):
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        log.error("Background task %s failed", task.get_name(), exc_info=task.exception())
+
+async def drain_background_tasks(timeout: float = 10):
+    """Let pending reveals finish on shutdown, cancel whatever is left after `timeout`."""
+    if not _background_tasks:
+        return
+    _, pending = await asyncio.wait(set(_background_tasks), timeout=timeout)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+
+# =========================
+# Jackpot events
+# =========================
+# A 777 goes onto _jackpot_queue and becomes a row in jackpot_events, keyed by
+# (chat_id, message_id) so a redelivered update can't announce twice. Workers
+# post the group announcement and DM every notifier concurrently, then mark the
+# row done. Rows left open by a crash, a transient send error or a full queue
+# are claimed again by jackpot_recovery(), on this replica or another one; the
+# row remembers which DMs already went out, and after JACKPOT_MAX_ATTEMPTS it
+# is marked 'failed'. Refusals (blocked bot, chat not found) are never retried.
+JACKPOT_WORKERS          = int(os.getenv("JACKPOT_WORKERS", "32"))
+JACKPOT_QUEUE_MAX        = int(os.getenv("JACKPOT_QUEUE_MAX", "1000"))
+JACKPOT_CLAIM_TIMEOUT    = float(os.getenv("JACKPOT_CLAIM_TIMEOUT", "120"))
+JACKPOT_RECOVER_INTERVAL = float(os.getenv("JACKPOT_RECOVER_INTERVAL", "60"))
+JACKPOT_MAX_ATTEMPTS     = int(os.getenv("JACKPOT_MAX_ATTEMPTS", "5"))
+
+class JackpotEvent(NamedTuple):
+    chat_id: int
+    message_id: int
+    user_id: int | None
+    username: str | None
+    thread_id: int | None
+    due: float               # loop time to announce at, after the dice animation
+    claimed: bool = False    # row already claimed by us (recovered events)
+    announced: bool = False  # group reply already went out before a crash
+    notified: tuple = ()     # notifiers a previous attempt already DMed
+
+_jackpot_queue: asyncio.Queue = asyncio.Queue(maxsize=JACKPOT_QUEUE_MAX)
+_jackpot_tasks: list[asyncio.Task] = []
+
+def enqueue_jackpot(msg, user):
+    """Hand a 777 to the jackpot workers; never waits."""
+    ev = JackpotEvent(
+        msg.chat_id, msg.message_id, user.id if user else None, user.username if user else None,
+        msg.message_thread_id if msg.is_topic_message else None,
+        asyncio.get_running_loop().time() + DICE_REVEAL_DELAY,
+    )
+    try:
+        _jackpot_queue.put_nowait(ev)
+    except asyncio.QueueFull:
+        # workers are behind: park it in the table, jackpot_recovery() delivers it
+        jackpot_results.inc(result="deferred")
+        spawn(persist_jackpot(ev, claim=False), name=f"jackpot-park:{ev.chat_id}:{ev.message_id}")
+
+@timed_query("persist_jackpot")
+async def persist_jackpot(ev: JackpotEvent, claim: bool = True) -> bool:
+    """Insert the event; False if (chat_id, message_id) was already recorded."""
+    async with db_acquire() as conn:
+        return bool(await conn.fetchval("""
+            INSERT INTO jackpot_events (chat_id, message_id, user_id, username, thread_id,
+                                        status, attempts, claimed_by, claimed_at)
+            VALUES ($1, $2, $3, $4, $5,
+                    CASE WHEN $6::bool THEN 'sending' ELSE 'pending' END,
+                    CASE WHEN $6::bool THEN 1 ELSE 0 END, $7,
+                    CASE WHEN $6::bool THEN now() END)
+            ON CONFLICT (chat_id, message_id) DO NOTHING
+            RETURNING 1
+        """, ev.chat_id, ev.message_id, ev.user_id, ev.username, ev.thread_id, claim,
+            BOT_INSTANCE if claim else None))
+
+@timed_query("claim_jackpots")
+async def claim_jackpots(limit: int) -> list:
+    async with db_acquire() as conn:
+        return await conn.fetch("""
+            UPDATE jackpot_events e
+               SET status = 'sending', claimed_by = $1, claimed_at = now(), attempts = e.attempts + 1
+              FROM (
+                SELECT chat_id, message_id FROM jackpot_events
+                 WHERE (status = 'pending'
+                        OR (status = 'sending' AND claimed_at < now() - make_interval(secs => $2)))
+                   AND attempts < $4
+                 ORDER BY created_at
+                 LIMIT $3
+                   FOR UPDATE SKIP LOCKED
+              ) c
+             WHERE e.chat_id = c.chat_id AND e.message_id = c.message_id
+            RETURNING e.chat_id, e.message_id, e.user_id, e.username, e.thread_id, e.announced, e.notified
+        """, BOT_INSTANCE, float(JACKPOT_CLAIM_TIMEOUT), limit, JACKPOT_MAX_ATTEMPTS)
+
+@timed_query("give_up_jackpots")
+async def give_up_jackpots() -> int:
+    """Mark events that used up JACKPOT_MAX_ATTEMPTS as 'failed' so they stop looking open and get pruned."""
+    async with db_acquire() as conn:
+        res = await conn.execute("""
+            UPDATE jackpot_events SET status = 'failed'
+             WHERE attempts >= $2
+               AND (status = 'pending'
+                    OR (status = 'sending' AND claimed_at < now() - make_interval(secs => $1)))
+        """, float(JACKPOT_CLAIM_TIMEOUT), JACKPOT_MAX_ATTEMPTS)
+    return int(res.rsplit(" ", 1)[-1])
+
+@timed_query("record_jackpot")
+async def record_jackpot(ev: JackpotEvent, announced: bool = False, notified: list[int] | None = None,
+                        done: bool = False):
+    """Save progress on the event row; flags and notifiers only ever accumulate."""
+    async with db_acquire() as conn:
+        await conn.execute("""
+            UPDATE jackpot_events
+               SET announced = announced OR $3,
+                   notified  = notified || $4::bigint[],
+                   status    = CASE WHEN $5 THEN 'done' ELSE status END
+             WHERE chat_id=$1 AND message_id=$2
+        """, ev.chat_id, ev.message_id, announced, notified or [], done)
+
+@timed_query("get_notifiers")
+async def get_notifiers(chat_id: int) -> list[int]:
+    """Extra notifiers (/addnotify); the contact's own user_id is added by the caller."""
+    async with db_acquire() as conn:
+        rows = await conn.fetch("SELECT user_id FROM jackpot_notifiers WHERE chat_id=$1 ORDER BY created_at", chat_id)
+    return [r["user_id"] for r in rows]
+
+@timed_query("add_notifier")
+async def add_notifier(chat_id: int, user_id: int):
+    async with db_acquire() as conn:
+        await conn.execute("""
+            INSERT INTO jackpot_notifiers (chat_id, user_id) VALUES ($1, $2) ON CONFLICT DO NOTHING
+        """, chat_id, user_id)
+
+@timed_query("remove_notifier")
+async def remove_notifier(chat_id: int, user_id: int) -> bool:
+    async with db_acquire() as conn:
+        res = await conn.execute("DELETE FROM jackpot_notifiers WHERE chat_id=$1 AND user_id=$2", chat_id, user_id)
+    return res.endswith(" 1")
+
+async def _announce_jackpot(bot, ev: JackpotEvent, row):
+    contact_line, reply_markup, parse_mode = jackpot_contact(*row) if row else ("", None, None)
+    text = tr("jackpot", user=ev.username, contact_line=contact_line)
+    try:
+        await bot.send_message(
+            ev.chat_id, text, reply_markup=reply_markup, parse_mode=parse_mode, disable_web_page_preview=True,
+            message_thread_id=ev.thread_id,
+            reply_parameters=ReplyParameters(ev.message_id, allow_sending_without_reply=True),
+        )
+    except (Forbidden, BadRequest) as ex:
+        # removed from the group since the roll, or can't post there anymore
+        note_chat_failure(ev.chat_id, ex)
+        log.info("Jackpot reply to %s failed: %s", ev.chat_id, ex)
+        return
+    note_chat_ok(ev.chat_id)
+
+async def _notify_jackpot(bot, ev: JackpotEvent, uid: int) -> int:
+    """DM one notifier; returns `uid` once it needs no retry. Transient errors raise."""
+    try:
+        await bot.send_message(chat_id=uid, text=tr("jackpot_dm", user=ev.username))
+    except (Forbidden, BadRequest) as ex:
+        # never started the bot, blocked it, or "chat not found" — a retry won't change that
+        log.info("Jackpot DM to notifier %s failed: %s", uid, ex)
+    return uid
+
+async def handle_jackpot(bot, ev: JackpotEvent):
+    persisted = ev.claimed
+    if not persisted:
+        try:
+            if not await persist_jackpot(ev):
+                jackpot_results.inc(result="duplicate")
+                return
+            persisted = True
+        except DatabaseBusy:
+            # announce anyway; a winner matters more than the outbox row
+            log.warning("Jackpot %s:%s not persisted: database busy", ev.chat_id, ev.message_id)
+
+    delay = ev.due - asyncio.get_running_loop().time()
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+    # Jackpot text + contact and notifiers for this chat if set
+    try:
+        row = await get_contact_db(ev.chat_id)
+        extra = await get_notifiers(ev.chat_id)
+    except DatabaseBusy:
+        # still announce the win, just without the contact line / DMs
+        log.warning("Jackpot in %s announced without contact: database busy", ev.chat_id)
+        row, extra = None, []
+    notifiers = list(dict.fromkeys(([row[1]] if row and row[1] else []) + extra))
+
+    async def announce():
+        # a reply Telegram refuses for good counts as handled too; only transient errors retry it
+        if not ev.announced:
+            await _announce_jackpot(bot, ev, row)
+            if persisted:
+                await record_jackpot(ev, announced=True)
+
+    # the group reply and every DM not already sent by an earlier attempt go out together
+    pending = [uid for uid in notifiers if uid not in ev.notified]
+    results = await asyncio.gather(announce(), *(_notify_jackpot(bot, ev, uid) for uid in pending),
+                                   return_exceptions=True)
+    errors = [r for r in results if isinstance(r, BaseException)]
+    if persisted:
+        notified = [uid for uid in results[1:] if not isinstance(uid, BaseException)]
+        await record_jackpot(ev, notified=notified, done=not errors)
+    if errors:
+        # row stays 'sending'; jackpot_recovery() retries what's left after JACKPOT_CLAIM_TIMEOUT
+        jackpot_results.inc(result="failed")
+        raise errors[0]
+    jackpot_results.inc(result="recovered" if ev.claimed else "announced")
+
+async def _jackpot_worker(bot):
+    background_sends.set(True)
+    while True:
+        ev = await _jackpot_queue.get()
+        try:
+            await handle_jackpot(bot, ev)
+        except Exception:
+            log.exception("Jackpot %s:%s failed", ev.chat_id, ev.message_id)
+        finally:
+            _jackpot_queue.task_done()
+
+async def jackpot_recovery(interval: float = JACKPOT_RECOVER_INTERVAL):
+    """Re-queue events nobody finished: after a crash, or parked when the queue was full."""
+    while True:
+        try:
+            given_up = await give_up_jackpots()
+            if given_up:
+                jackpot_results.inc(given_up, result="given_up")
+                log.warning("Gave up on %d jackpot events after %d attempts", given_up, JACKPOT_MAX_ATTEMPTS)
+            for r in await claim_jackpots(JACKPOT_WORKERS):
+                await _jackpot_queue.put(JackpotEvent(
+                    r["chat_id"], r["message_id"], r["user_id"], r["username"], r["thread_id"],
+                    due=0, claimed=True, announced=r["announced"], notified=tuple(r["notified"]),
+                ))
+            async with db_acquire() as conn:
+                await conn.execute("""
+                    DELETE FROM jackpot_events
+                     WHERE status IN ('done', 'failed') AND created_at < now() - interval '7 days'
+                """)
+        except Exception:
+            log.exception("Jackpot recovery failed")
+        await asyncio.sleep(interval)
+
+def start_jackpot_workers(bot, workers: int = JACKPOT_WORKERS, recover: bool = True):
+    if _jackpot_tasks:
+        return
+    _jackpot_tasks.extend(spawn(_jackpot_worker(bot), name=f"jackpot-worker:{i}") for i in range(workers))
+    if recover:
+        _jackpot_tasks.append(spawn(jackpot_recovery(), name="jackpot-recovery"))
+
+async def stop_jackpot_workers(timeout: float = 10):
+    """Let queued jackpots go out (up to `timeout`), then stop the workers."""
+    try:
+        await asyncio.wait_for(_jackpot_queue.join(), timeout)
+    except asyncio.TimeoutError:
+        log.warning("%d jackpot events left queued; recovery will pick them up", _jackpot_queue.qsize())
+    for task in _jackpot_tasks:
+        task.cancel()
+    await asyncio.gather(*_jackpot_tasks, return_exceptions=True)
+    _jackpot_tasks.clear()
+
+# =========================
+# Update dedup
+# =========================
+# Telegram redelivers an update when it doesn't get a timely 200, and a second
+# copy of a 777 would announce twice. Both webhook front ends already answer as
+# soon as the update is queued (PTB's run_webhook and the sharded receiver);
+# this drops the redeliveries that still get through: first by a bounded window
+# of recent update_ids in memory, then optionally in processed_updates so
+# replicas behind one webhook see each other's ids.
+UPDATE_DEDUP_WINDOW = int(os.getenv("UPDATE_DEDUP_WINDOW", "20000"))
+UPDATE_DEDUP_TTL    = float(os.getenv("UPDATE_DEDUP_TTL", "86400"))  # Telegram stops retrying well before this
+UPDATE_DEDUP_DB     = os.getenv("UPDATE_DEDUP_DB", "0") == "1"
+UPDATE_DEDUP_PRUNE  = float(os.getenv("UPDATE_DEDUP_PRUNE", "600"))
+
+_seen_updates = TTLCache(UPDATE_DEDUP_WINDOW, UPDATE_DEDUP_TTL)
+
+def first_sighting(seen: TTLCache, update_id: int) -> bool:
+    if update_id in seen:
+        return False
+    seen.set(update_id, True)
+    return True
+
+@timed_query("claim_update")
+async def claim_update(update_id: int) -> bool:
+    """Record update_id in processed_updates; False if some replica already did."""
+    async with db_acquire() as conn:
+        return bool(await conn.fetchval("""
+            INSERT INTO processed_updates (update_id) VALUES ($1) ON CONFLICT DO NOTHING RETURNING 1
+        """, update_id))
+
+async def dedupe_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Group -2: stop every other handler for an update_id we've already handled."""
+    if not first_sighting(_seen_updates, update.update_id):
+        duplicate_updates.inc(layer="memory")
+        raise ApplicationHandlerStop
+    if UPDATE_DEDUP_DB:
+        try:
+            fresh = await claim_update(update.update_id)
+        except DatabaseBusy:
+            # fail open: a rare double beats dropping updates while Postgres is slow
+            return
+        if not fresh:
+            duplicate_updates.inc(layer="db")
+            raise ApplicationHandlerStop
+
+async def prune_processed_updates(interval: float = UPDATE_DEDUP_PRUNE):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            async with db_acquire() as conn:
+                await conn.execute("DELETE FROM processed_updates WHERE seen_at < now() - make_interval(secs => $1)",
+                                   UPDATE_DEDUP_TTL)
+        except Exception:
+            log.exception("Pruning processed_updates failed")
+
+# =========================
+# Dice throttling
+# =========================
+# Token buckets per (chat_id, user_id) and per chat_id. Rolls over the limit are
+# dropped before any other handler runs; a 777 is never dropped and does not
+# spend tokens, since the group has already seen it land. Idle buckets expire out
+# of the caches, so memory stays bounded by DICE_THROTTLE_MAX_KEYS. A rate of 0
+# disables that limit.
+DICE_USER_RATE  = float(os.getenv("DICE_USER_RATE", "0.5"))   # rolls/s per user in a chat
+DICE_USER_BURST = float(os.getenv("DICE_USER_BURST", "3"))
+DICE_CHAT_RATE  = float(os.getenv("DICE_CHAT_RATE", "5"))     # rolls/s per chat
+DICE_CHAT_BURST = float(os.getenv("DICE_CHAT_BURST", "20"))
+DICE_THROTTLE_IDLE     = float(os.getenv("DICE_THROTTLE_IDLE", "120"))
+DICE_THROTTLE_MAX_KEYS = int(os.getenv("DICE_THROTTLE_MAX_KEYS", "50000"))
+_user_buckets = TTLCache(DICE_THROTTLE_MAX_KEYS, DICE_THROTTLE_IDLE)
+_chat_buckets = TTLCache(DICE_THROTTLE_MAX_KEYS, DICE_THROTTLE_IDLE)
+throttle_hits: Counter = Counter()  # "user" / "chat" -> dropped rolls
+
+def _bucket(cache: TTLCache, key, rate: float, burst: float) -> TokenBucket:
+    bucket = cache.get(key)
+    if bucket is None:
+        bucket = TokenBucket(rate, burst)
+    cache.set(key, bucket)  # refresh the idle timer
+    return bucket
+
+def allow_roll(chat_id: int, user_id: int | None) -> bool:
+    if DICE_USER_RATE > 0 and user_id is not None:
+        if not _bucket(_user_buckets, (chat_id, user_id), DICE_USER_RATE, DICE_USER_BURST).try_acquire():
+            throttle_hits["user"] += 1
+            return False
+    if DICE_CHAT_RATE > 0:
+        if not _bucket(_chat_buckets, chat_id, DICE_CHAT_RATE, DICE_CHAT_BURST).try_acquire():
+            throttle_hits["chat"] += 1
+            return False
+    return True
+
+async def throttle_dice(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # runs in handler group -1, before onUpdateReceived
+    msg = update.effective_message
+    if msg.dice and msg.dice.value == JACKPOT_VALUE:
+        return
+    user = update.effective_user
+    if not allow_roll(msg.chat_id, user.id if user else None):
+        raise ApplicationHandlerStop
+
 # =========================
 # Message handler
 # =========================
+def _message_outcome(update: Update) -> str:
+    msg = update.message
+    if not msg:
+        return "other"
+    if msg.dice:
+        if msg.dice.value == JACKPOT_VALUE:
+            return "jackpot"
+        return "triple" if msg.dice.value in TRIPLE_VALUES else "roll"
+    return "text" if msg.text else "other"
+
+@timed_handler("message", outcome=_message_outcome)
 async def onUpdateReceived(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Auto-cache group title
     if update.effective_chat and update.effective_chat.type in ("group", "supergroup"):
-        await refresh_group_title(context, update.effective_chat.id)
+        await refresh_group_title(context, update.effective_chat.id, update.effective_chat.title)
 
     msg = update.message
     if not msg:
@@ -414,71 +2746,80 @@ async def onUpdateReceived(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if msg.dice:
         user = msg.from_user
         d = msg.dice
-        await asyncio.sleep(1.5)
-
-        if d.value == 64:
-            # Jackpot text + contact for this chat if set
-            row = await get_contact_db(update.effective_chat.id)
-            contact_line = ""
-            reply_markup = None
-            parse_mode = None
-            if row:
-                username, uid, name = row
-                if username:
-                    #contact_line = f"\n\nPlease contact @{username} to claim your prize!"
-                    contact_line = f"\n\nנא לשלוח הודעה ל{username} על מנת לקבל את הפרס!"
-                    reply_markup = InlineKeyboardMarkup(
-                        [[InlineKeyboardButton(f"Message @{username}", url=f"https://t.me/{username}")]]
-                    )
-                elif uid:
-                    contact_line = f'\nPlease contact <a href="tg://user?id={uid}">{name or "this user"}</a>'
-                    parse_mode = ParseMode.HTML
-
-            text = f"המשתמש {user.username} הוציא 777! כל הכבוד! {contact_line}"
-            #text = f"User: {user.username} Just Hit the JACKPOT!{contact_line}"
-            #7759745932
-            await msg.reply_text(text, reply_markup=reply_markup, parse_mode=parse_mode, disable_web_page_preview=True)
-
-            # After you determine (username, uid, name) from the DB:
-            notify_text = f"The user @{user.username} just won 777! They will message you!"
-
-            if uid:
-                try:
-                    await context.bot.send_message(chat_id=uid, text=notify_text)
-                except Forbidden:
-                    # they haven't started the bot or blocked it — nothing else to do
-                    pass
+
+        if d.emoji == DiceEmoji.SLOT_MACHINE and user:
+            count_roll(msg.chat_id, user, d.value)
+
+        if d.value == JACKPOT_VALUE:
+            # announced after the animation by the jackpot workers
+            enqueue_jackpot(msg, user)
 
         #elif d.value in {1, 22, 43}:
             #await msg.reply_text(f"המשתמש {user.username} הוציא 3 בשורה! נא לנסות שוב!")
             #await msg.reply_text(f"User: {user.username} Got 3 in a ROW!")
 
-        # simple log
-        print(f"Dice {d.emoji} = {d.value}")
+        log_event("jackpot" if d.value == JACKPOT_VALUE else "dice", chat_id=msg.chat_id,
+                  user_id=user.id if user else None, emoji=d.emoji, value=d.value)
         return
 
     # Regular text
     if msg.text:
         user = msg.from_user
-        print(f"User {user.username} ({user.id}) said: {msg.text}")
+        if LOG_MESSAGE_TEXT:
+            log_event("text", chat_id=msg.chat_id, user_id=user.id if user else None, text=msg.text)
+        else:
+            log_event("text", chat_id=msg.chat_id, user_id=user.id if user else None, length=len(msg.text))
 
 # =========================
 # App bootstrap
 # =========================
-def main():
-    # Env
-    bot_token  = os.getenv("ENV_BOTTOKEN")          # you chose this name; keeping it
-    webhook_url = os.getenv("WEBHOOK_URL")
-    secret      = os.getenv("WEBHOOK_SECRET")       # optional
-    port        = int(os.getenv("PORT", "8080"))
-
-    if not bot_token:
-        raise RuntimeError("Missing ENV_BOTTOKEN")
-    if not webhook_url:
-        raise RuntimeError("Missing WEBHOOK_URL")
-
-    # Build app & handlers
-    app = Application.builder().token(bot_token).build()
+# Ensure DB exists before starting bot loop
+# init DB inside PTB's loop
+async def _post_init(app: Application):
+    await init_db()
+
+    # in sharded mode only the first worker registers commands
+    worker = app.bot_data.get("worker", 0)
+    if worker == 0:
+        await sync_bot_commands(app.bot)
+
+    app.bot_data["metrics_server"] = await start_metrics_server(METRICS_PORT + worker if METRICS_PORT else 0)
+    app.bot_data["contacts_listener"] = spawn(contacts_listener(), name="contacts-listener")
+    _title_writes.start()
+    _roll_writes.start()
+    _health_writes.start()
+    # announce jackpots, including ones a crashed replica left unfinished
+    start_jackpot_workers(app.bot)
+    if UPDATE_DEDUP_DB and worker == 0:
+        app.bot_data["dedup_pruner"] = spawn(prune_processed_updates(), name="dedup-pruner")
+    # send broadcasts if no other replica / worker already does
+    app.bot_data["broadcast_poller"] = spawn(broadcast_poller(app.bot), name="broadcast-poller")
+
+async def _post_stop(app: Application):
+    # PTB calls this before app.shutdown() closes the bot's HTTP client, so queued
+    # jackpots and pending background sends can still go out; post_shutdown is too late.
+    # Broadcasts give their claimed rows back; another replica (or the next boot) resumes them
+    background = [app.bot_data.get("broadcast_poller"), app.bot_data.get("contacts_listener"),
+                  app.bot_data.get("dedup_pruner")]
+    for task in [*background, *_running_broadcasts.values()]:
+        if task:
+            task.cancel()
+    await stop_jackpot_workers()
+    await _title_writes.stop()
+    await _roll_writes.stop()
+    await _health_writes.stop()
+    await drain_background_tasks()
+    # broadcasts that finished during the drain may have noted chat health
+    await _health_writes.flush()
+
+async def _post_shutdown(app: Application):
+    if app.bot_data.get("metrics_server"):
+        app.bot_data["metrics_server"].close()
+
+def build_application(bot_token: str, request=None) -> Application:
+    """The Application with all handlers registered; `request` lets benchmarks swap in a fake Bot API."""
+    request = request or TelegramRequest()
+    app = Application.builder().token(bot_token).request(request).build()
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("help", help_cmd))
     app.add_handler(CommandHandler("setcontact", set_contact))
@@ -486,9 +2827,19 @@ def main():
     app.add_handler(CommandHandler("unsetcontact", unset_contact))
     app.add_handler(CommandHandler("setnotify", setnotify))
     app.add_handler(CommandHandler("unsetnotify", unsetnotify))
+    app.add_handler(CommandHandler("addnotify", addnotify))
+    app.add_handler(CommandHandler("removenotify", removenotify))
     app.add_handler(CommandHandler("setpaid", setpaid))
     app.add_handler(CommandHandler("getpaid", getpaid))
     app.add_handler(CommandHandler("sendad", sendad))
+    app.add_handler(CommandHandler("sendto", sendto))
+    app.add_handler(CommandHandler("segment", segment_cmd))
+    app.add_handler(CommandHandler("adstatus", adstatus))
+    app.add_handler(CommandHandler("adcancel", adcancel))
+    app.add_handler(CommandHandler("stats", stats_cmd))
+    app.add_handler(CommandHandler("leaderboard", leaderboard))
+    app.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_TITLE, on_new_chat_title))
+    app.add_handler(ChatMemberHandler(on_chat_member, ChatMemberHandler.ANY_CHAT_MEMBER))
 
     # Filters (separate for groups vs private, as you wanted)
     dice_filter    = filters.Dice.ALL
@@ -496,28 +2847,188 @@ def main():
     group_filter   = filters.ChatType.GROUPS  & (text_filter | dice_filter)
     private_filter = filters.ChatType.PRIVATE & (text_filter | dice_filter | filters.Sticker.ALL)
 
+    app.add_handler(TypeHandler(Update, dedupe_update), group=-2)
+    app.add_handler(MessageHandler(dice_filter, throttle_dice), group=-1)
     app.add_handler(MessageHandler(group_filter, onUpdateReceived))
     app.add_handler(MessageHandler(private_filter, onUpdateReceived))
 
-    # Webhook path must match WEBHOOK_URL path
-    path = urlparse(webhook_url).path.lstrip("/")
-
-    # Ensure DB exists before starting bot loop
-    # init DB inside PTB's loop
-    async def _post_init(app):
-        await init_db()
-
-        await app.bot.set_my_commands([
-            BotCommand("start", "Check bot status"),
-            BotCommand("help", "Show help"),
-            BotCommand("setcontact", "Set group contact (@username or via reply)"),
-            BotCommand("getcontact", "Show group contact"),
-            BotCommand("unsetcontact", "Clear group contact"),
-            BotCommand("setnotify", "Set notifier user_id (DM on JACKPOT)"),
-            BotCommand("unsetnotify", "Clear notifier user_id"),
-        ])
+    app.add_error_handler(on_error)
 
     app.post_init = _post_init
+    app.post_stop = _post_stop
+    app.post_shutdown = _post_shutdown
+    return app
+
+# =========================
+# Sharded workers
+# =========================
+# WEB_WORKERS > 1: this process only receives webhook POSTs and hands each update
+# to worker hash(chat_id) % N over a multiprocessing queue. Every worker runs its
+# own Application, caches and asyncpg pool, and handles its queue in order, so
+# updates for one chat are still processed one after another. Bot-wide work
+# isn't multiplied: worker 0 syncs commands and prunes update ids, broadcasts run
+# only where BROADCAST_LOCK is held at BROADCAST_GLOBAL_RATE, and the workers split
+# what is left of TG_GLOBAL_RATE for everything else.
+WEB_WORKERS      = int(os.getenv("WEB_WORKERS", "1"))
+WORKER_QUEUE_MAX = int(os.getenv("WORKER_QUEUE_MAX", "10000"))
+_STOP = None  # queue sentinel
+
+def update_chat_id(data: dict) -> int | None:
+    """chat.id of a raw update dict, wherever it lives (message, chat_member, callback_query.message, ...)."""
+    for key, value in data.items():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat and "id" in chat:
+            return chat["id"]
+    return None
+
+def shard_for(data: dict, workers: int) -> int:
+    chat_id = update_chat_id(data)
+    key = chat_id if chat_id is not None else data.get("update_id", 0)
+    return abs(key) % workers
+
+async def _worker_loop(index: int, bot_token: str, inbox):
+    # Telegram's ~30 msg/s is per bot: whichever worker holds BROADCAST_LOCK sends
+    # broadcasts at BROADCAST_GLOBAL_RATE, the workers split the rest
+    rate = max(TG_GLOBAL_RATE - BROADCAST_GLOBAL_RATE, 1) / WEB_WORKERS
+    limiter = RateLimiter(rate, TG_GROUP_RATE, TG_GROUP_BURST, TG_PRIVATE_RATE, TG_PRIVATE_BURST)
+    app = build_application(bot_token, request=TelegramRequest(limiter=limiter, broadcast_share=True))
+    app.bot_data["worker"] = index
+    loop = asyncio.get_running_loop()
+    await app.initialize()
+    await _post_init(app)
+    await app.start()
+    log.info("Worker %s ready", index)
+    try:
+        while True:
+            raw = await loop.run_in_executor(None, inbox.get)
+            if raw is _STOP:
+                break
+            try:
+                await app.update_queue.put(Update.de_json(json.loads(raw), app.bot))
+            except Exception:
+                log.exception("Worker %s dropped a malformed update", index)
+    finally:
+        await app.stop()
+        await _post_stop(app)
+        await app.shutdown()
+        await _post_shutdown(app)
+        log.info("Worker %s stopped", index)
+
+def _worker_main(index: int, bot_token: str, inbox):
+    # the front process owns shutdown; it tells us to stop through the queue
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(_worker_loop(index, bot_token, inbox))
+
+def run_sharded(bot_token: str, webhook_url: str, secret: str | None, port: int, workers: int):
+    import tornado.web
+
+    ctx = multiprocessing.get_context("spawn")
+    inboxes = [ctx.Queue(WORKER_QUEUE_MAX) for _ in range(workers)]
+    procs: list = [None] * workers
+    seen = TTLCache(UPDATE_DEDUP_WINDOW, UPDATE_DEDUP_TTL)
+
+    def spawn_worker(i: int):
+        procs[i] = ctx.Process(target=_worker_main, args=(i, bot_token, inboxes[i]), name=f"bot-worker-{i}")
+        procs[i].start()
+
+    def replace_inbox(i: int) -> int | str:
+        old = inboxes[i]
+        inboxes[i] = ctx.Queue(WORKER_QUEUE_MAX)
+        try:
+            lost = old.qsize()
+        except NotImplementedError:  # macOS
+            lost = "unknown"
+        # don't let exit wait on the feeder thread of a queue nobody reads
+        old.cancel_join_thread()
+        old.close()
+        return lost
+
+    class IngressHandler(tornado.web.RequestHandler):
+        SUPPORTED_METHODS = ("POST",)
+
+        def post(self):
+            if secret and self.request.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret:
+                raise tornado.web.HTTPError(403)
+            try:
+                data = json.loads(self.request.body)
+            except ValueError:
+                raise tornado.web.HTTPError(400)
+            update_id = data.get("update_id")
+            if update_id is not None and not first_sighting(seen, update_id):
+                # already queued once: 200 so Telegram stops retrying
+                duplicate_updates.inc(layer="front")
+                return
+            try:
+                inboxes[shard_for(data, workers)].put_nowait(self.request.body)
+            except queue.Full:
+                # Telegram retries; better than buffering without bound
+                seen.pop(update_id)
+                raise tornado.web.HTTPError(503)
+
+    async def front():
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+
+        for i in range(workers):
+            spawn_worker(i)
+        path = urlparse(webhook_url).path.rstrip("/") or "/"
+        web = tornado.web.Application([(rf"{path}/?", IngressHandler)], log_function=lambda h: None)
+        server = web.listen(port, address="0.0.0.0")
+        async with Bot(bot_token) as bot:
+            await bot.set_webhook(webhook_url, secret_token=secret, allowed_updates=ALLOWED_UPDATES)
+        log.info("Front receiver on :%s, %s workers", port, workers)
+
+        # restart workers that die, on a fresh queue: a worker killed inside
+        # inbox.get() never releases the queue's read lock, so nothing could read
+        # the old one again. Its pending updates were already acked and are lost.
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), 5)
+            except asyncio.TimeoutError:
+                pass
+            for i, p in enumerate(procs):
+                if not stop.is_set() and not p.is_alive():
+                    lost = replace_inbox(i)
+                    log.error("Worker %s exited with %s, restarting; %s queued updates lost",
+                              i, p.exitcode, lost)
+                    spawn_worker(i)
+
+        log.info("Shutting down")
+        server.stop()
+        for inbox in inboxes:
+            inbox.put(_STOP)
+        for p in procs:
+            await loop.run_in_executor(None, p.join, 30)
+            if p.is_alive():
+                p.terminate()
+
+    asyncio.run(front())
+
+def main():
+    # Env
+    bot_token  = os.getenv("ENV_BOTTOKEN")          # you chose this name; keeping it
+    webhook_url = os.getenv("WEBHOOK_URL")
+    secret      = os.getenv("WEBHOOK_SECRET")       # optional
+    port        = int(os.getenv("PORT", "8080"))
+
+    if not bot_token:
+        raise RuntimeError("Missing ENV_BOTTOKEN")
+    if not webhook_url:
+        raise RuntimeError("Missing WEBHOOK_URL")
+
+    if WEB_WORKERS > 1:
+        return run_sharded(bot_token, webhook_url, secret, port, WEB_WORKERS)
+
+    # Build app & handlers
+    app = build_application(bot_token)
+
+    # Webhook path must match WEBHOOK_URL path
+    path = urlparse(webhook_url).path.lstrip("/")
 
     # make sure a loop exists on Py 3.12
     try:
@@ -531,6 +3042,7 @@ def main():
         url_path=path,               # must match the path in WEBHOOK_URL
         webhook_url=webhook_url,
         secret_token=secret,         # optional
+        allowed_updates=ALLOWED_UPDATES,  # chat_member updates are opt-in
     )
 
 if __name__ == "__main__":
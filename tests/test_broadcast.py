@@ -0,0 +1,79 @@
+# send_with_retry, the per-chat step of the broadcast engine, against bench.py's
+# fake Bot API answering scripted 429s and 403s.
+import os
+import sys
+import json
+import time
+import asyncio
+
+import httpx
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bench
+import main
+
+RETRY_AFTER = 1
+
+
+class ScriptedBotAPI(bench.FakeBotAPI):
+    """FakeBotAPI that answers the next sendMessage calls to a chat with the given error codes."""
+
+    def __init__(self, script: dict[int, list[int]]):
+        super().__init__()
+        self.script = script
+        self.attempts: dict[int, int] = {}
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        if request.url.path.endswith("/sendMessage"):
+            chat_id = int(dict(httpx.QueryParams((await request.aread()).decode()))["chat_id"])
+            self.attempts[chat_id] = self.attempts.get(chat_id, 0) + 1
+            errors = self.script.get(chat_id)
+            if errors:
+                return _error(errors.pop(0))
+        return await super().handle_async_request(request)
+
+def _error(code: int) -> httpx.Response:
+    if code == 429:
+        body = {"ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {RETRY_AFTER}",
+                "parameters": {"retry_after": RETRY_AFTER}}
+    else:
+        body = {"ok": False, "error_code": 403, "description": "Forbidden: bot was kicked from the group chat"}
+    return httpx.Response(code, content=json.dumps(body).encode())
+
+
+@pytest.fixture
+def health(monkeypatch):
+    monkeypatch.setattr(main._health_writes, "_pending", {})
+    # surface the first 429 to send_with_retry instead of retrying it in TelegramRequest
+    monkeypatch.setattr(main, "TG_MAX_429_RETRIES", 0)
+    return main._health_writes
+
+async def send(api, chat_id: int, limiter: main.RateLimiter):
+    main.background_sends.set(True)  # as in run_broadcast
+    async with main.Bot(f"{bench.BOT_ID}:test", request=bench.make_request(api, global_rate=1000)) as bot:
+        t0 = time.monotonic()
+        result = await main.send_with_retry(bot, limiter, chat_id, "ad")
+        return result, time.monotonic() - t0
+
+
+def test_retry_after_pauses_the_limiter_and_retries(health):
+    api = ScriptedBotAPI({-100: [429]})
+    limiter = main.RateLimiter(1000, 1000, 10)
+    (status, error), elapsed = asyncio.run(send(api, -100, limiter))
+
+    assert status == "sent" and error is None
+    assert api.attempts[-100] == 2
+    # the second attempt waited out retry_after on the shared limiter
+    assert elapsed >= RETRY_AFTER
+    assert dict(health.items()) == {-100: (True, 0, None)}
+
+def test_forbidden_is_skipped_without_retrying(health):
+    api = ScriptedBotAPI({-200: [403, 403]})
+    limiter = main.RateLimiter(1000, 1000, 10)
+    (status, error), _ = asyncio.run(send(api, -200, limiter))
+
+    assert status == "skipped"
+    assert "kicked" in error
+    assert api.attempts[-200] == 1
+    assert dict(health.items()) == {-200: (False, 1, "forbidden")}
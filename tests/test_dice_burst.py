@@ -0,0 +1,122 @@
+# Rolls/s under a simulated burst, with the real 1.5 s reveal delay. Runs the
+# Application main() builds against bench.py's fake Bot API and stub pool.
+import os
+import sys
+import time
+import asyncio
+import contextlib
+
+import pytest
+from telegram import Update
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bench
+import main
+
+REVEAL_DELAY = 1.5
+MIN_ROLLS_PER_SEC = 200  # sleeping in the handler capped this below 1
+
+
+@pytest.fixture(scope="module")
+def loop():
+    # the jackpot queue and write-behinds bind to the first loop that waits on them
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+@pytest.fixture
+def bot(monkeypatch):
+    monkeypatch.setattr(main, "DICE_REVEAL_DELAY", REVEAL_DELAY)
+    monkeypatch.setattr(main, "DICE_USER_RATE", 0)
+    monkeypatch.setattr(main, "DICE_CHAT_RATE", 0)
+    monkeypatch.setattr(main, "_pool", bench.FakePool())
+    bench.reset_state()
+    api = bench.FakeBotAPI()
+    app = main.build_application(f"{bench.BOT_ID}:test", request=bench.make_request(api, global_rate=1000))
+    return app, api
+
+@contextlib.asynccontextmanager
+async def running(app):
+    """Background workers up like _post_init starts them, torn down the way PTB stops the app."""
+    await app.initialize()
+    main._title_writes.start()
+    main._roll_writes.start()
+    main._health_writes.start()
+    main.start_jackpot_workers(app.bot, recover=False)
+    try:
+        yield
+    finally:
+        await main._post_stop(app)
+        await app.shutdown()
+
+async def burst(app, updates) -> float:
+    """Feed updates through the pipeline one by one, as PTB does; returns seconds taken."""
+    updates = [Update.de_json(data, app.bot) for data in updates]
+    t0 = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for update in updates:
+            await app.process_update(update)
+    return time.perf_counter() - t0
+
+def announced(api, chats) -> set:
+    return {chat for chat, _ in api.sent if chat in chats}
+
+
+def test_dice_burst_rolls_per_second(loop, bot):
+    app, api = bot
+    factory = bench.UpdateFactory(seed=1)
+    n = 1000
+
+    async def go():
+        async with running(app):
+            return await burst(app, bench.dice_flood(factory, n))
+
+    elapsed = loop.run_until_complete(go())
+    assert n / elapsed >= MIN_ROLLS_PER_SEC, f"{n / elapsed:.0f} rolls/s"
+
+def test_jackpots_do_not_hold_the_pipeline(loop, bot):
+    app, api = bot
+    factory = bench.UpdateFactory(seed=2)
+    chats = [-100 - i for i in range(20)]
+
+    async def go():
+        async with running(app):
+            elapsed = await burst(app, [factory.dice(chat, 7, value=main.JACKPOT_VALUE) for chat in chats])
+            # nothing announced before the animation is over
+            assert not announced(api, chats)
+            await asyncio.sleep(REVEAL_DELAY + 1)
+            return elapsed
+
+    elapsed = loop.run_until_complete(go())
+    assert elapsed < REVEAL_DELAY, f"20 jackpots took {elapsed:.2f}s to process"
+    assert announced(api, chats) == set(chats)
+
+def test_queued_jackpots_are_announced_on_stop(loop, bot):
+    app, api = bot
+    factory = bench.UpdateFactory(seed=3)
+    chats = [-300 - i for i in range(10)]
+
+    async def go():
+        async with running(app):
+            await burst(app, [factory.dice(chat, 7, value=main.JACKPOT_VALUE) for chat in chats])
+        # running() went through _post_stop before the HTTP client was shut down
+
+    loop.run_until_complete(go())
+    assert announced(api, chats) == set(chats)
+
+def test_throttle_never_drops_a_jackpot(loop, bot, monkeypatch):
+    monkeypatch.setattr(main, "DICE_USER_RATE", 0.5)
+    monkeypatch.setattr(main, "DICE_USER_BURST", 3)
+    app, api = bot
+    factory = bench.UpdateFactory(seed=4)
+    chat = -400
+
+    async def go():
+        async with running(app):
+            # the fourth quick roll from the same user is over the limit
+            await burst(app, [factory.dice(chat, 7, value=1) for _ in range(3)]
+                             + [factory.dice(chat, 7, value=main.JACKPOT_VALUE), factory.dice(chat, 7, value=1)])
+
+    loop.run_until_complete(go())
+    assert announced(api, [chat]) == {chat}
+    assert main.throttle_hits == {"user": 1}